@@ -1,148 +1,1098 @@
 import cv2
 import numpy as np
-import glob
+import argparse
+import csv
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from slice_stack import open_stack, load_track_records, merge_label_volumes, LabelVolumeWriter, SliceWriter, \
+    TrackRecordWriter, PNG_COMPRESSION, TRACK_RECORD_DTYPE
 
 # Configuration parameters
 GRAY_VALUE = 80
 WINDOW_WIDTH = 768
 WINDOW_HEIGHT = 180
 LABELING_ENABLED = True  # Enable to display fiber numbers
+SINGLE_PASS_LABELING = True  # Label each slice once instead of re-contouring every search window
+STALE_TIERS = (2, 5, 10)  # Stale slice counts after which the IoU threshold is relaxed
+MATCH_THRESHOLDS = np.array([0.90, 0.8, 0.7, 0.6])  # IoU threshold per staleness tier
+PARALLEL_CHUNKS = 0  # Number of chunks tracked in separate processes; 0 tracks sequentially
+CHUNK_OVERLAP = 20  # Slices each chunk is tracked ahead of its range to settle before stitching
+STITCH_IOU = 0.5  # Minimum IoU for two chunks' yarns to be stitched into one identity
+PREDICTIVE_WINDOWS = False  # Size each search window from a constant-velocity prediction of the yarn
+MOTION_SMOOTHING = 0.5  # Weight of the newest displacement in the velocity and error estimates
+MOTION_NOISE = 2.0  # Expected drift in pixels per slice added to the uncertainty while a yarn is unmatched
+MOTION_DEADBAND = 1.5  # Predicted drifts shorter than this many pixels are centroid rounding noise
+WINDOW_SIGMAS = 3.0  # Prediction standard deviations added around the predicted box
+WINDOW_MIN_MARGIN = 8  # Smallest margin in pixels around the predicted box
+# Write one compressed label volume <sample>_labels.npz and a track table instead of one PNG per slice.
+# With checkpoints the volume is written in parts, merged into <sample>_labels.npz when the run finishes
+OUTPUT_VOLUME = False
+QUIET_MODE = False  # Print a progress summary every PROGRESS_INTERVAL slices instead of per-slice lists
+PROGRESS_INTERVAL = 100
+TRACK_RECORDS = True  # Write per-yarn, per-slice geometry to <sample>_tracks.bin
+CHECKPOINT_INTERVAL = 50  # Save the tracker state to <sample>_checkpoint.npz every this many slices; 0 disables
 
-def update_and_remove_contour(key, best_contour, best_mask, count_list, count_plus_list, count_plus2_list):
-    """Update contour information and remove from count lists"""
-    targets[key] = best_mask
-    cv2.drawContours(output_img, [best_contour], 0, key + GRAY_VALUE, -1)
-
-    # Calculate new centroid
-    moments = cv2.moments(best_contour)
-    if moments["m00"] != 0:
-        center_x = int(moments["m10"] / moments["m00"])
-        center_y = int(moments["m01"] / moments["m00"])
-        centers[key] = (center_x, center_y)
-    else:
-        # Handle division by zero if necessary
-        pass
+# Binary mask cropped to its bounding box; (x, y) is the top-left corner in the full frame
+CroppedMask = namedtuple('CroppedMask', ['x', 'y', 'mask', 'area'])
 
-    contour_update_counters[key] = 0
-    # Remove key from all non-updated lists
-    count_list = [x for x in count_list if x != key]
-    count_plus_list = [x for x in count_plus_list if x != key]
-    count_plus2_list = [x for x in count_plus2_list if x != key]
 
-    return count_list, count_plus_list, count_plus2_list
+def search_window(frame_shape, center, width=WINDOW_WIDTH, height=WINDOW_HEIGHT):
+    """
+    Calculate the search window around a centroid, clipped to the frame.
 
-if __name__ == '__main__':
-    input_files = glob.glob('./Tracking/Sample_A_warp/*.png')
-    output_directory = './Tracked/'
+    :param frame_shape: Shape of the slice (height, width)
+    :param center: (x, y) centroid of the target in the previous slice
+    :param width: Window width
+    :param height: Window height
+    :return: (start_x, start_y, end_x, end_y) of the window
+    """
+    center_x, center_y = center
+    start_x = max(0, center_x - width // 2)
+    end_x = min(frame_shape[1], center_x + width // 2)
+    start_y = max(0, center_y - height // 2)
+    end_y = min(frame_shape[0], center_y + height // 2)
+    return start_x, start_y, end_x, end_y
 
-    target_count = 1
-    targets = {}
-    centers = {}
-    non_updated_count = []
-    non_updated_count_plus = []
-    non_updated_count_plus2 = []
 
-    start_index = 300
-    end_index = 1381
+def shift_cropped_mask(cropped, dx, dy, frame_shape):
+    """
+    Move a cropped mask by an offset, keeping its box inside the frame.
 
-    # Initialize seed image and contour library
-    seed_image = cv2.imread(input_files[start_index], cv2.IMREAD_GRAYSCALE)
-    contours, _ = cv2.findContours(seed_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contour_update_counters = {idx + 1: 0 for idx in range(len(contours))}
-
-    for contour in contours:
-        base_mask = np.zeros_like(seed_image)
-        cv2.drawContours(base_mask, [contour], 0, 255, -1)
-        targets[target_count] = base_mask
-
-        # Calculate contour centroid
-        moments = cv2.moments(contour)
-        center_x = int(moments["m10"] / moments["m00"])
-        center_y = int(moments["m01"] / moments["m00"])
-        centers[target_count] = (center_x, center_y)
-
-        target_count += 1
-
-    # Main tracking loop
-    for frame_index in range(start_index, end_index):
-        current_file = input_files[frame_index]
-        gray_frame = cv2.imread(current_file, cv2.IMREAD_GRAYSCALE)
-        _, threshold = cv2.threshold(gray_frame, 0, 255, 0)
-        output_img = np.zeros_like(gray_frame)
+    :param cropped: CroppedMask to move
+    :param dx: Horizontal offset in pixels
+    :param dy: Vertical offset in pixels
+    :param frame_shape: Shape of the slice (height, width)
+    :return: Moved CroppedMask sharing the mask array
+    """
+    height, width = cropped.mask.shape
+    x = min(max(cropped.x + dx, 0), frame_shape[1] - width)
+    y = min(max(cropped.y + dy, 0), frame_shape[0] - height)
+    return CroppedMask(x, y, cropped.mask, cropped.area)
+
+
+def contour_center(contour):
+    """
+    Calculate the integer centroid of a contour.
+
+    :param contour: Contour in full-frame coordinates
+    :return: (x, y) centroid, or None for a degenerate contour
+    """
+    moments = cv2.moments(contour)
+    if moments["m00"] == 0:
+        return None
+    return int(moments["m10"] / moments["m00"]), int(moments["m01"] / moments["m00"])
+
+
+def crop_contour_mask(contour):
+    """
+    Rasterize a filled contour into a mask cropped to the contour's bounding box.
+
+    :param contour: Contour in full-frame coordinates
+    :return: CroppedMask of the filled contour
+    """
+    x, y, w, h = cv2.boundingRect(contour)
+    mask = np.zeros((h, w), dtype=np.uint8)
+    cv2.drawContours(mask, [contour], 0, 255, -1, offset=(-x, -y))
+    return CroppedMask(x, y, mask, cv2.countNonZero(mask))
+
+
+def cropped_iou(mask_a, mask_b):
+    """
+    Calculate the IoU of two cropped masks without building full-frame masks.
+
+    The intersection is only evaluated where the two bounding boxes overlap,
+    and the union follows from the stored areas.
+
+    :param mask_a: First CroppedMask
+    :param mask_b: Second CroppedMask
+    :return: Intersection over union
+    """
+    height_a, width_a = mask_a.mask.shape
+    height_b, width_b = mask_b.mask.shape
+    x0 = max(mask_a.x, mask_b.x)
+    y0 = max(mask_a.y, mask_b.y)
+    x1 = min(mask_a.x + width_a, mask_b.x + width_b)
+    y1 = min(mask_a.y + height_a, mask_b.y + height_b)
+
+    intersection = 0
+    if x0 < x1 and y0 < y1:
+        overlap_a = mask_a.mask[y0 - mask_a.y:y1 - mask_a.y, x0 - mask_a.x:x1 - mask_a.x]
+        overlap_b = mask_b.mask[y0 - mask_b.y:y1 - mask_b.y, x0 - mask_b.x:x1 - mask_b.x]
+        intersection = cv2.countNonZero(cv2.bitwise_and(overlap_a, overlap_b))
+
+    union = mask_a.area + mask_b.area - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def paste_cropped_mask(img, cropped, value):
+    """
+    Write a cropped mask into a full-frame image with the given value.
+
+    :param img: Full-frame image to write into
+    :param cropped: CroppedMask to paste
+    :param value: Gray value for the mask pixels
+    """
+    height, width = cropped.mask.shape
+    region = img[cropped.y:cropped.y + height, cropped.x:cropped.x + width]
+    region[cropped.mask == 255] = value
+
+
+def cropped_region_contains(img, cropped, value):
+    """
+    Check whether a value occurs in the full-frame image inside a cropped mask's bounding box.
+
+    :param img: Full-frame image
+    :param cropped: CroppedMask whose bounding box is searched
+    :param value: Gray value to look for
+    :return: True if any pixel in the box has the value
+    """
+    height, width = cropped.mask.shape
+    region = img[cropped.y:cropped.y + height, cropped.x:cropped.x + width]
+    return bool((region == value).any())
+
+
+class SliceComponents:
+    """
+    Blobs of one slice, extracted once and indexed by bounding box.
+
+    All targets are matched against the blobs in one vectorized pass, so the
+    cost of a slice scales with its area instead of yarns x window area.
+    """
+
+    def __init__(self, gray_frame):
+        """
+        Extract the external contours of the slice and collect their boxes and centroids.
+
+        A single full-frame findContours pass is used rather than
+        connectedComponentsWithStats: it is several times cheaper on these
+        binary slices and keeps the filled-contour masks of the per-window mode.
+
+        :param gray_frame: Current slice (grayscale, non-zero pixels are foreground)
+        """
+        self.contours, _ = cv2.findContours(gray_frame, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        self.boxes = np.array([cv2.boundingRect(contour) for contour in self.contours],
+                              dtype=np.int64).reshape(-1, 4)
+        self.centroids = [contour_center(contour) for contour in self.contours]
+        self._masks = {}
+
+    def cropped_mask(self, index):
+        """
+        Build the cropped mask of a single component, cached for the rest of the slice.
+
+        :param index: Component index into self.contours
+        :return: CroppedMask of the component
+        """
+        if index not in self._masks:
+            self._masks[index] = crop_contour_mask(self.contours[index])
+        return self._masks[index]
+
+    def label_image(self, frame_shape):
+        """
+        Rasterize the filled components into a label image.
+
+        :param frame_shape: Shape of the slice (height, width)
+        :return: uint16 image with component index + 1 per pixel and 0 for background
+        """
+        labels = np.zeros(frame_shape, dtype=np.uint16)
+        for index in range(len(self.contours)):
+            cv2.drawContours(labels, self.contours, index, index + 1, -1)
+        return labels
+
+    def iou_matrix(self, targets, windows, frame_shape):
+        """
+        Calculate the IoU of every target against every component in one pass.
+
+        Each target pixel is encoded as a (target row, component label) pair and
+        the pairs are counted with a single np.bincount over the label image.
+        Components whose box misses a target's search window get an IoU of 0.
+
+        :param targets: List of target CroppedMasks
+        :param windows: (start_x, start_y, end_x, end_y) search window per target
+        :param frame_shape: Shape of the slice (height, width)
+        :return: targets x components IoU matrix
+        """
+        component_count = len(self.contours)
+        if not targets or component_count == 0:
+            return np.zeros((len(targets), component_count))
+
+        # Only the pixels under each target's mask are read from the label image
+        labels = self.label_image(frame_shape)
+        pairs = []
+        for row, target in enumerate(targets):
+            height, width = target.mask.shape
+            region = labels[target.y:target.y + height, target.x:target.x + width]
+            pairs.append(region[target.mask == 255].astype(np.int64) + row * (component_count + 1))
+        intersection = np.bincount(np.concatenate(pairs), minlength=len(targets) * (component_count + 1))
+        intersection = intersection.reshape(len(targets), component_count + 1)[:, 1:]
+
+        component_areas = np.array([self.cropped_mask(index).area for index in range(component_count)])
+        target_areas = np.array([target.area for target in targets])
+        union = target_areas[:, None] + component_areas[None, :] - intersection
+        iou = np.divide(intersection, union, out=np.zeros(intersection.shape), where=union > 0)
+
+        start_x, start_y, end_x, end_y = (column[:, None] for column in np.array(windows).T)
+        x, y, w, h = self.boxes.T
+        in_window = (x < end_x) & (x + w > start_x) & (y < end_y) & (y + h > start_y)
+        iou[~in_window] = 0
+        return iou
+
+
+def assign_matches(iou, thresholds):
+    """
+    Assign components to targets globally, each component to at most one target.
+
+    Pairs above their target's threshold are accepted in order of decreasing
+    IoU, ties going to the lower target row. As all thresholds are above 0.5
+    and components are disjoint, a target has at most one eligible component,
+    so this greedy pass is the maximum-IoU assignment.
+
+    :param iou: targets x components IoU matrix
+    :param thresholds: IoU threshold per target row
+    :return: Dictionary of target row -> component index
+    """
+    rows, columns = np.nonzero(iou > np.asarray(thresholds)[:, None])
+    order = np.lexsort((rows, -iou[rows, columns]))
+
+    matches = {}
+    used_columns = set()
+    for row, column in zip(rows[order], columns[order]):
+        if row not in matches and column not in used_columns:
+            matches[row] = column
+            used_columns.add(column)
+    return matches
+
+
+class YarnState:
+    """
+    Per-yarn tracking state in fixed-size arrays indexed by yarn ID.
+
+    Staleness is a counter plus a derived tier instead of growing ID lists, so
+    lookups are O(1) and memory stays flat however long the stack is.
+    """
+
+    def __init__(self, yarn_count):
+        """
+        Allocate the state arrays.
+
+        :param yarn_count: Number of yarns; IDs run from 1 to yarn_count and row 0 is unused
+        """
+        size = yarn_count + 1
+        self.stale = np.zeros(size, dtype=np.int32)
+        self.tier = np.zeros(size, dtype=np.int8)
+        self.last_seen = np.zeros(size, dtype=np.int32)
+        self.centers = np.zeros((size, 2), dtype=np.int32)
+        self.boxes = np.zeros((size, 4), dtype=np.int32)
+        self.carried = np.zeros(size, dtype=np.int32)
+        self.areas = np.zeros(size, dtype=np.int32)
+        # Outcome of the current slice: IoU of the accepted match (NaN if none) and carried-forward flag
+        self.match_iou = np.full(size, np.nan, dtype=np.float32)
+        self.carried_now = np.zeros(size, dtype=bool)
+        # Constant-velocity motion model: centroid drift per slice and mean squared prediction error
+        self.velocity = np.zeros((size, 2), dtype=np.float32)
+        self.motion_error = np.zeros(size, dtype=np.float32)
+
+    def begin_slice(self):
+        """
+        Clear the per-slice match outcome before a new slice is tracked.
+        """
+        self.match_iou[:] = np.nan
+        self.carried_now[:] = False
+
+    def mark_updated(self, key, slice_index, mask, center, iou=np.nan):
+        """
+        Record a match and reset the yarn's staleness.
+
+        :param key: Yarn ID
+        :param slice_index: Index of the slice the yarn was matched in
+        :param mask: CroppedMask of the matched blob
+        :param center: (x, y) centroid of the blob, or None to keep the previous one
+        :param iou: IoU of the accepted match, NaN for the seed
+        """
+        gap = slice_index - self.last_seen[key]
+        if center is not None and gap > 0:
+            self.update_motion(key, np.asarray(center, dtype=np.float32), gap)
+
+        self.stale[key] = 0
+        self.tier[key] = 0
+        self.last_seen[key] = slice_index
+        self.boxes[key] = (mask.x, mask.y, mask.mask.shape[1], mask.mask.shape[0])
+        self.areas[key] = mask.area
+        self.match_iou[key] = iou
+        # Keep the previous centroid for a degenerate contour
+        if center is not None:
+            self.centers[key] = center
+
+    def update_motion(self, key, center, gap):
+        """
+        Blend a new observed centroid into the yarn's velocity and prediction error.
+
+        :param key: Yarn ID
+        :param center: Observed (x, y) centroid
+        :param gap: Number of slices since the previous match
+        """
+        error = center - (self.centers[key] + self.velocity[key] * gap)
+        displacement = (center - self.centers[key]) / gap
+        self.velocity[key] += MOTION_SMOOTHING * (displacement - self.velocity[key])
+        self.motion_error[key] += MOTION_SMOOTHING * (float(error @ error) / 2 - self.motion_error[key])
+
+    def predict(self, keys, slice_index):
+        """
+        Predict where yarns are on a slice from their last match and velocity.
+
+        :param keys: Yarn IDs
+        :param slice_index: Slice to predict for
+        :return: (N, 2) predicted centroids and (N,) standard deviations in pixels
+        """
+        gap = (slice_index - self.last_seen[keys]).astype(np.float32)
+        centers = self.centers[keys] + self.velocity[keys] * gap[:, None]
+        sigma = np.sqrt(self.motion_error[keys] + MOTION_NOISE ** 2 * np.maximum(gap - 1, 0))
+        return centers, sigma
+
+    def mark_stale(self, key):
+        """
+        Count one more slice without a match and update the yarn's tier.
+
+        :param key: Yarn ID
+        """
+        self.stale[key] += 1
+        self.carried[key] += 1
+        self.carried_now[key] = True
+        self.tier[key] = sum(self.stale[key] > limit for limit in STALE_TIERS)
+
+    def tier_counts(self):
+        """
+        Count the yarns in each staleness tier.
+
+        :return: Array with the number of yarns per tier, tier 0 first
+        """
+        return np.bincount(self.tier[1:], minlength=len(STALE_TIERS) + 1)
+
+    def center(self, key):
+        """
+        Look up the last centroid of a yarn.
+
+        :param key: Yarn ID
+        :return: (x, y) centroid
+        """
+        return int(self.centers[key, 0]), int(self.centers[key, 1])
+
+    def thresholds(self, keys):
+        """
+        Look up the IoU each yarn needs to be updated, relaxed the longer it has gone stale.
+
+        :param keys: Yarn IDs
+        :return: Array of IoU thresholds
+        """
+        return MATCH_THRESHOLDS[self.tier[keys]]
+
+    def stale_ids(self, tier):
+        """
+        List the yarns that have reached at least the given staleness tier.
+
+        :param tier: Tier from 1 to len(STALE_TIERS)
+        :return: Array of yarn IDs
+        """
+        return np.flatnonzero(self.tier >= tier)
+
+
+class YarnTracker:
+    """
+    Track yarn cross-sections through a slice stack by IoU matching.
+
+    Every target is stored as a CroppedMask, so a slice costs work proportional
+    to the yarn areas and search windows instead of yarns x full-frame pixels.
+    """
+
+    def __init__(self, seed_image, single_pass=SINGLE_PASS_LABELING, labeling=LABELING_ENABLED,
+                 predictive=PREDICTIVE_WINDOWS):
+        """
+        Initialize the contour library from the seed slice.
+
+        :param seed_image: Binary seed slice (grayscale)
+        :param single_pass: Match all targets at once against blobs extracted once per slice,
+                            instead of greedily per search window
+        :param labeling: Draw the yarn numbers into the output
+        :param predictive: Place and size search windows from each yarn's predicted motion
+        """
+        self.single_pass = single_pass
+        self.predictive = predictive
+        self.labeling = labeling
+        self.slice_index = 0
+        self.targets = {}
+
+        contours, _ = cv2.findContours(seed_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        self.state = YarnState(len(contours))
+        for target_id, contour in enumerate(contours, start=1):
+            self.targets[target_id] = crop_contour_mask(contour)
+            self.state.mark_updated(target_id, self.slice_index, self.targets[target_id], contour_center(contour))
+
+    def save_checkpoint(self, path, **extra):
+        """
+        Save the full tracker state so that tracking can continue after a restart.
+
+        The target masks are bit-packed into one array, so a checkpoint is a few
+        hundred kilobytes. The file is replaced atomically; a crash while saving
+        keeps the previous checkpoint.
+
+        :param path: Checkpoint .npz path
+        :param extra: Arrays or values stored alongside, e.g. the index of the last tracked slice
+        """
+        keys = np.array(list(self.targets), dtype=np.int32)
+        masks = [self.targets[key] for key in keys]
+        geometry = np.array([(mask.x, mask.y, mask.mask.shape[1], mask.mask.shape[0], mask.area)
+                             for mask in masks], dtype=np.int64).reshape(-1, 5)
+        bits = np.packbits(np.concatenate([mask.mask.ravel() > 0 for mask in masks])) if masks else \
+            np.zeros(0, dtype=np.uint8)
+        state = {f'state_{name}': array for name, array in vars(self.state).items()}
+
+        with open(path + '.tmp', 'wb') as file:
+            np.savez(file, keys=keys, geometry=geometry, bits=bits, slice_index=self.slice_index, **state, **extra)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load_checkpoint(cls, path, single_pass=SINGLE_PASS_LABELING, labeling=LABELING_ENABLED,
+                        predictive=PREDICTIVE_WINDOWS):
+        """
+        Restore a tracker saved by save_checkpoint.
+
+        :param path: Checkpoint .npz path
+        :param single_pass: See __init__
+        :param labeling: See __init__
+        :param predictive: See __init__
+        :return: The restored tracker and a dictionary of the extra values stored with it
+        """
+        with np.load(path) as checkpoint:
+            data = {name: checkpoint[name] for name in checkpoint.files}
+
+        tracker = cls.__new__(cls)
+        tracker.single_pass = single_pass
+        tracker.predictive = predictive
+        tracker.labeling = labeling
+        tracker.slice_index = int(data.pop('slice_index'))
+
+        keys, geometry, bits = data.pop('keys'), data.pop('geometry'), data.pop('bits')
+        pixels = np.unpackbits(bits, count=int((geometry[:, 2] * geometry[:, 3]).sum())) * np.uint8(255)
+        tracker.targets = {}
+        offset = 0
+        for key, (x, y, width, height, area) in zip(keys, geometry):
+            mask = pixels[offset:offset + width * height].reshape(height, width)
+            tracker.targets[int(key)] = CroppedMask(int(x), int(y), mask, int(area))
+            offset += width * height
+
+        tracker.state = YarnState(0)
+        for name in [name for name in data if name.startswith('state_')]:
+            setattr(tracker.state, name[len('state_'):], data.pop(name))
+        return tracker, data
+
+    def update_and_remove_contour(self, key, best_mask, best_center, best_iou, output_img):
+        """Update contour information and reset its staleness"""
+        self.targets[key] = best_mask
+        paste_cropped_mask(output_img, best_mask, key + GRAY_VALUE)
+        self.state.mark_updated(key, self.slice_index, best_mask, best_center, best_iou)
+
+    def find_candidates(self, gray_frame, window):
+        """
+        Extract candidate contours inside a search window.
+
+        :param gray_frame: Current slice (grayscale)
+        :param window: (start_x, start_y, end_x, end_y) search window
+        :return: List of (CroppedMask, center) pairs in full-frame coordinates
+        """
+        start_x, start_y, end_x, end_y = window
+        if start_x >= end_x or start_y >= end_y:
+            return []
 
-        for contour_id, contour_mask in targets.items():
-            working_mask = np.zeros_like(gray_frame)
-            center_x, center_y = centers[contour_id]
+        # Process ROI in place; the offset maps contours back to full-frame coordinates
+        roi = gray_frame[start_y:end_y, start_x:end_x]
+        detected_contours, _ = cv2.findContours(roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                                offset=(start_x, start_y))
+        return [(crop_contour_mask(contour), contour_center(contour)) for contour in detected_contours]
 
-            # Define ROI boundaries
-            start_x = max(0, center_x - WINDOW_WIDTH // 2)
-            end_x = min(gray_frame.shape[1], center_x + WINDOW_WIDTH // 2)
-            start_y = max(0, center_y - WINDOW_HEIGHT // 2)
-            end_y = min(gray_frame.shape[0], center_y + WINDOW_HEIGHT // 2)
+    def track_records(self, slice_index):
+        """
+        Collect the geometry and match outcome of every yarn on the last tracked slice.
 
-            # Process ROI
-            roi = gray_frame[start_y:end_y, start_x:end_x]
-            working_mask[start_y:end_y, start_x:end_x] = roi
+        :param slice_index: Slice index in the stack to store with the records
+        :return: Array of TRACK_RECORD_DTYPE, one record per yarn
+        """
+        keys = np.array(list(self.targets))
+        state = self.state
+        records = np.zeros(len(keys), dtype=TRACK_RECORD_DTYPE)
+        records['slice'] = slice_index
+        records['yarn'] = keys
+        records['center_x'] = state.centers[keys, 0]
+        records['center_y'] = state.centers[keys, 1]
+        records['area'] = state.areas[keys]
+        records['box_x'] = state.boxes[keys, 0]
+        records['box_y'] = state.boxes[keys, 1]
+        records['box_width'] = state.boxes[keys, 2]
+        records['box_height'] = state.boxes[keys, 3]
+        records['iou'] = state.match_iou[keys]
+        records['tier'] = state.tier[keys]
+        records['carried'] = state.carried_now[keys]
+        return records
 
-            detected_contours, _ = cv2.findContours(working_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    def search_targets(self, keys, frame_shape):
+        """
+        Get the search window of each target and its mask moved by the predicted drift.
+
+        Without prediction the window has the fixed size around the last
+        centroid. With prediction it covers the last and the predicted mask box,
+        grown by WINDOW_SIGMAS standard deviations of the prediction error and at
+        most twice the fixed window.
+
+        :param keys: Target IDs
+        :param frame_shape: Shape of the slice (height, width)
+        :return: List of windows and list of moved CroppedMasks, None where nothing moves
+        """
+        if not self.predictive:
+            windows = [search_window(frame_shape, self.state.center(key)) for key in keys]
+            return windows, [None] * len(keys)
+
+        centers, sigma = self.state.predict(np.array(keys, dtype=np.intp), self.slice_index)
+        drift = centers - self.state.centers[keys]
+        drift[np.hypot(drift[:, 0], drift[:, 1]) < MOTION_DEADBAND] = 0
+        shifts = np.rint(drift).astype(int)
+        margins = WINDOW_SIGMAS * sigma + WINDOW_MIN_MARGIN
+
+        windows = []
+        moved_targets = []
+        for key, (dx, dy), margin in zip(keys, shifts, margins):
+            target = self.targets[key]
+            moved = shift_cropped_mask(target, int(dx), int(dy), frame_shape) if dx or dy else None
+            height, width = target.mask.shape
+            start_x, start_y = min(target.x, target.x + dx), min(target.y, target.y + dy)
+            end_x, end_y = max(target.x, target.x + dx) + width, max(target.y, target.y + dy) + height
+            window_width = min(int(end_x - start_x + 2 * margin), 2 * WINDOW_WIDTH)
+            window_height = min(int(end_y - start_y + 2 * margin), 2 * WINDOW_HEIGHT)
+            center = ((start_x + end_x) // 2, (start_y + end_y) // 2)
+            windows.append(search_window(frame_shape, center, window_width, window_height))
+            moved_targets.append(moved)
+        return windows, moved_targets
+
+    def match_slice(self, gray_frame, output_img):
+        """
+        Match all targets against the slice's blobs at once and draw the matches.
+
+        A target that is predicted to move is also compared at its predicted
+        position, and the better of the two IoUs counts.
+
+        :param gray_frame: Current slice (grayscale)
+        :param output_img: Output image to draw the matched blobs into
+        """
+        keys = list(self.targets)
+        components = SliceComponents(gray_frame)
+        windows, moved_targets = self.search_targets(keys, gray_frame.shape)
+        iou = components.iou_matrix([self.targets[key] for key in keys], windows, gray_frame.shape)
+        moving = [row for row, moved in enumerate(moved_targets) if moved is not None]
+        if moving:
+            moved_iou = components.iou_matrix([moved_targets[row] for row in moving],
+                                              [windows[row] for row in moving], gray_frame.shape)
+            iou[moving] = np.maximum(iou[moving], moved_iou)
+        matches = assign_matches(iou, self.state.thresholds(keys))
+
+        for row, index in sorted(matches.items()):
+            self.update_and_remove_contour(keys[row], components.cropped_mask(index),
+                                           components.centroids[index], iou[row, index], output_img)
+
+    def match_windows(self, gray_frame, output_img):
+        """
+        Match each target greedily against the contours in its own search window.
+
+        :param gray_frame: Current slice (grayscale)
+        :param output_img: Output image to draw the matched contours into
+        """
+        keys = list(self.targets)
+        for contour_id, window, moved_mask in zip(keys, *self.search_targets(keys, gray_frame.shape)):
+            contour_mask = self.targets[contour_id]
             max_iou = 0
-            best_contour = None
             best_mask = None
+            best_center = None
 
-            for detected_contour in detected_contours:
-                temp_mask = np.zeros_like(gray_frame)
-                cv2.drawContours(temp_mask, [detected_contour], 0, 255, -1)
-
-                intersection = np.logical_and(contour_mask, temp_mask)
-                union = np.logical_or(contour_mask, temp_mask)
-                iou = np.sum(intersection) / np.sum(union)
+            for candidate_mask, candidate_center in self.find_candidates(gray_frame, window):
+                iou = cropped_iou(contour_mask, candidate_mask)
+                if moved_mask is not None:
+                    iou = max(iou, cropped_iou(moved_mask, candidate_mask))
 
                 if iou > max_iou:
                     max_iou = iou
-                    best_contour = detected_contour
-                    best_mask = temp_mask
+                    best_mask = candidate_mask
+                    best_center = candidate_center
 
             # Update logic based on IOU thresholds
-            if max_iou > 0.90:
-                non_updated_count, non_updated_count_plus, non_updated_count_plus2 = update_and_remove_contour(
-                    contour_id, best_contour, best_mask, non_updated_count, non_updated_count_plus, non_updated_count_plus2
-                )
-
-            elif contour_id in non_updated_count and max_iou > 0.8:
-                non_updated_count, non_updated_count_plus, non_updated_count_plus2 = update_and_remove_contour(
-                    contour_id, best_contour, best_mask, non_updated_count, non_updated_count_plus, non_updated_count_plus2
-                )
-
-            elif contour_id in non_updated_count_plus and max_iou > 0.7:
-                non_updated_count, non_updated_count_plus, non_updated_count_plus2 = update_and_remove_contour(
-                    contour_id, best_contour, best_mask, non_updated_count, non_updated_count_plus, non_updated_count_plus2
-                )
-
-            elif contour_id in non_updated_count_plus2 and max_iou > 0.6:
-                non_updated_count, non_updated_count_plus, non_updated_count_plus2 = update_and_remove_contour(
-                    contour_id, best_contour, best_mask, non_updated_count, non_updated_count_plus, non_updated_count_plus2
-                )
+            if max_iou > self.state.thresholds(contour_id):
+                self.update_and_remove_contour(contour_id, best_mask, best_center, max_iou, output_img)
+
+    def track(self, gray_frame):
+        """
+        Match every target against the current slice and render the labelled output.
+
+        :param gray_frame: Current slice (grayscale)
+        :return: Output image with each yarn drawn as contour_id + GRAY_VALUE
+        """
+        self.slice_index += 1
+        self.state.begin_slice()
+        output_img = np.zeros_like(gray_frame)
+        if self.single_pass:
+            self.match_slice(gray_frame, output_img)
+        else:
+            self.match_windows(gray_frame, output_img)
 
         # Final update checking
-        for contour_id, contour_mask in targets.items():
-            if (output_img == (contour_id + GRAY_VALUE)).sum() == 0:
-                output_img[contour_mask == 255] = contour_id + GRAY_VALUE
-                contour_update_counters[contour_id] += 1
-
-                if contour_update_counters[contour_id] > 2:
-                    non_updated_count.append(contour_id)
-                if contour_update_counters[contour_id] > 5:
-                    non_updated_count_plus.append(contour_id)
-                if contour_update_counters[contour_id] > 10:
-                    non_updated_count_plus2.append(contour_id)
+        for contour_id, contour_mask in self.targets.items():
+            if not cropped_region_contains(output_img, contour_mask, contour_id + GRAY_VALUE):
+                paste_cropped_mask(output_img, contour_mask, contour_id + GRAY_VALUE)
+                self.state.mark_stale(contour_id)
+            if self.labeling:
+                cv2.putText(output_img, str(contour_id), self.state.center(contour_id),
+                            cv2.FONT_HERSHEY_SIMPLEX, 1, 255, 2)
+
+        return output_img
+
+
+def open_output_writer(output_directory, sample_name, first_index):
+    """
+    Open the writer for the labelled slices from a given slice on.
+
+    A label volume is only readable once its archive is closed, so with
+    checkpoints enabled it is written in parts that are closed at every
+    checkpoint: <sample>_labels_<first slice>.npz. A resumed run replaces the
+    unfinished part that follows its checkpoint, and merge_label_parts joins
+    the parts into <sample>_labels.npz once the run finishes.
+
+    :param output_directory: Output directory
+    :param sample_name: Sample name used in the volume file names
+    :param first_index: Index of the first slice the writer receives
+    :return: LabelVolumeWriter in OUTPUT_VOLUME mode, else SliceWriter
+    """
+    if not OUTPUT_VOLUME:
+        return SliceWriter(output_directory, compression=PNG_COMPRESSION)
+    volume_name = f'{sample_name}_labels_{first_index:05d}.npz' if CHECKPOINT_INTERVAL else f'{sample_name}_labels.npz'
+    return LabelVolumeWriter(os.path.join(output_directory, volume_name))
+
+
+def label_volume_parts(output_directory, sample_name):
+    """
+    List the label volume parts of a sample written by open_output_writer.
+
+    :param output_directory: Output directory
+    :param sample_name: Sample name used in the volume file names
+    :return: List of (first slice index, path) pairs, in slice order
+    """
+    pattern = re.compile(re.escape(sample_name) + r'_labels_(\d+)\.npz$')
+    parts = []
+    for file_name in os.listdir(output_directory):
+        match = pattern.match(file_name)
+        if match:
+            parts.append((int(match.group(1)), os.path.join(output_directory, file_name)))
+    return sorted(parts)
+
+
+def merge_label_parts(output_directory, sample_name):
+    """
+    Merge the label volume parts of a finished run into <sample>_labels.npz and delete the parts.
+
+    A run extended with --resume appends its parts to the volume merged at the
+    end of the earlier run, so the result matches a single uninterrupted run.
+
+    :param output_directory: Output directory
+    :param sample_name: Sample name used in the volume file names
+    """
+    parts = [path for _, path in label_volume_parts(output_directory, sample_name)]
+    if not parts:
+        return
+    volume_path = os.path.join(output_directory, f'{sample_name}_labels.npz')
+    volumes = [volume_path] + parts if os.path.exists(volume_path) else parts
+    merge_label_volumes(volumes, volume_path)
+    for path in parts:
+        os.remove(path)
+
+
+def write_track_table(path, tracker, slice_names):
+    """
+    Write a per-yarn summary of a finished tracking run as CSV.
+
+    :param path: Output CSV path
+    :param tracker: YarnTracker after the last slice
+    :param slice_names: Names of the tracked slices, in tracking order
+    """
+    state = tracker.state
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Yarn', 'Gray Value', 'Last Matched Slice', 'Matched Slices', 'Carried Slices',
+                         'Stale Tier'])
+        for key in tracker.targets:
+            last_seen = state.last_seen[key]
+            # Slice 0 of the tracker is the seed, tracked again as the first slice
+            last_name = slice_names[last_seen - 1] if last_seen > 0 else slice_names[0]
+            writer.writerow([key, key + GRAY_VALUE, last_name, tracker.slice_index - state.carried[key],
+                             state.carried[key], state.tier[key]])
+
+
+def print_progress(tracker, frame_number, frame_count, current_file, start_time):
+    """
+    Print a one-line summary of the tracking progress.
+
+    :param tracker: YarnTracker after the current slice
+    :param frame_number: Number of slices tracked so far
+    :param frame_count: Total number of slices to track
+    :param current_file: Name of the current slice
+    :param start_time: time.time() at the start of the run
+    """
+    rate = frame_number / max(time.time() - start_time, 1e-9)
+    counts = ' '.join(f'{count}' for count in tracker.state.tier_counts())
+    print(f'{frame_number}/{frame_count} {current_file} {rate:.1f} slices/s, yarns per stale tier: {counts}')
+
+
+def report_slice(tracker, frame_number, frame_count, output_directory, current_file, start_time):
+    """
+    Print the per-slice stale yarn lists, or a progress summary every PROGRESS_INTERVAL slices in QUIET_MODE.
+
+    :param tracker: YarnTracker after the current slice
+    :param frame_number: Number of slices tracked so far
+    :param frame_count: Total number of slices to track
+    :param output_directory: Directory the slice is written to
+    :param current_file: Name of the current slice
+    :param start_time: time.time() at the start of the run
+    """
+    if not QUIET_MODE:
+        print(output_directory + current_file)
+        for tier in range(1, len(STALE_TIERS) + 1):
+            print(tracker.state.stale_ids(tier).tolist())
+    elif frame_number % PROGRESS_INTERVAL == 0 or frame_number == frame_count:
+        print_progress(tracker, frame_number, frame_count, current_file, start_time)
+
+
+def split_chunks(start_index, end_index, chunk_count, overlap):
+    """
+    Split a slice range into contiguous chunks, each seeded a few slices early.
+
+    :param start_index: First slice to track
+    :param end_index: Slice to stop before
+    :param chunk_count: Number of chunks
+    :param overlap: Number of slices a chunk is tracked before its own range
+    :return: List of (seed_index, chunk_start, chunk_end) per chunk
+    """
+    bounds = np.linspace(start_index, end_index, chunk_count + 1).astype(int)
+    return [(max(start_index, chunk_start - overlap), int(chunk_start), int(chunk_end))
+            for chunk_start, chunk_end in zip(bounds[:-1], bounds[1:]) if chunk_start < chunk_end]
+
+
+def track_chunk(args):
+    """
+    Track one chunk of the stack from its own seed slice and write its slices.
+
+    Every chunk except the first is written with its local yarn IDs and no
+    labels; relabel_chunk maps them to the stitched IDs afterwards.
+
+    :param args: Tuple of (stack folder, seed index, chunk start, chunk end, output directory, first chunk flag,
+                 record collection flag)
+    :return: Dictionary with the targets on the slice before the chunk ('head'), the targets on its
+             last slice ('tail'), the written slice names, the yarn centroids of every written slice
+             and, if collected, the track records of the written slices with local yarn IDs
+    """
+    stack_folder, seed_index, chunk_start, chunk_end, output_directory, is_first, collect_records = args
+    input_stack = open_stack(stack_folder)
+    tracker = YarnTracker(input_stack[seed_index], labeling=LABELING_ENABLED and is_first)
+
+    result = {'head': {}, 'tail': {}, 'names': [], 'centers': [], 'records': []}
+    start_time = time.time()
+    with SliceWriter(output_directory, compression=PNG_COMPRESSION) as writer:
+        for frame_index, (current_file, gray_frame) in enumerate(input_stack.iter_slices(seed_index, chunk_end),
+                                                                 start=seed_index):
+            output_img = tracker.track(gray_frame)
+            if frame_index == chunk_start - 1:
+                result['head'] = dict(tracker.targets)
+            if frame_index >= chunk_start:
+                writer.write(current_file, output_img)
+                result['names'].append(current_file)
+                result['centers'].append(tracker.state.centers.copy())
+                if collect_records:
+                    result['records'].append(tracker.track_records(frame_index))
+            report_slice(tracker, frame_index - seed_index + 1, chunk_end - seed_index, output_directory,
+                         current_file, start_time)
+    result['tail'] = dict(tracker.targets)
+    result['records'] = np.concatenate(result['records']) if result['records'] else \
+        np.zeros(0, dtype=TRACK_RECORD_DTYPE)
+    return result
+
+
+def stitch_identities(previous_tail, previous_ids, head):
+    """
+    Map a chunk's local yarn IDs to global IDs by IoU against the previous chunk on their shared slice.
+
+    The sequential tracker only ever follows the yarns of its seed slice, so a
+    yarn without a partner in the previous chunk is dropped (global ID 0)
+    rather than given a new identity.
+
+    :param previous_tail: Local ID -> CroppedMask of the previous chunk on its last slice
+    :param previous_ids: Local ID -> global ID of the previous chunk, 0 for dropped yarns
+    :param head: Local ID -> CroppedMask of this chunk on the same slice
+    :return: Local ID -> global ID of this chunk, 0 for dropped yarns
+    """
+    head_keys = list(head)
+    tail_keys = list(previous_tail)
+    iou = np.zeros((len(head_keys), len(tail_keys)))
+    for row, head_key in enumerate(head_keys):
+        for column, tail_key in enumerate(tail_keys):
+            iou[row, column] = cropped_iou(head[head_key], previous_tail[tail_key])
+    matches = assign_matches(iou, np.full(len(head_keys), STITCH_IOU))
+
+    return {head_key: previous_ids[tail_keys[matches[row]]] if row in matches else 0
+            for row, head_key in enumerate(head_keys)}
+
+
+def relabel_chunk(args):
+    """
+    Rewrite a chunk's slices with global yarn IDs and draw the labels.
+
+    :param args: Tuple of (output directory, slice names, per-slice centroids, local ID -> global ID)
+    """
+    output_directory, names, centers, ids = args
+    lookup = np.arange(256, dtype=np.uint8)
+    for local_id, global_id in ids.items():
+        lookup[local_id + GRAY_VALUE] = global_id + GRAY_VALUE if global_id else 0
+    ids = {local_id: global_id for local_id, global_id in ids.items() if global_id}
+
+    with SliceWriter(output_directory, compression=PNG_COMPRESSION) as writer:
+        for name, slice_centers in zip(names, centers):
+            output_img = lookup[cv2.imread(output_directory + name, cv2.IMREAD_GRAYSCALE)]
             if LABELING_ENABLED:
-                cv2.putText(output_img, str(contour_id), centers[contour_id], cv2.FONT_HERSHEY_SIMPLEX, 1, 255, 2)
+                for local_id, global_id in ids.items():
+                    center = (int(slice_centers[local_id, 0]), int(slice_centers[local_id, 1]))
+                    cv2.putText(output_img, str(global_id), center, cv2.FONT_HERSHEY_SIMPLEX, 1, 255, 2)
+            writer.write(name, output_img)
+
+
+def track_parallel(stack_folder, start_index, end_index, output_directory,
+                   chunk_count=PARALLEL_CHUNKS, overlap=CHUNK_OVERLAP, records=None):
+    """
+    Track a slice range in overlapping chunks on separate processes and stitch the yarn identities.
+
+    Each chunk is seeded `overlap` slices before its range, so its targets have
+    settled by the slice it shares with the previous chunk. Yarns are stitched
+    on that slice by IoU; yarns without a partner are dropped, so the output
+    carries the seed slice's yarns only, as in a sequential run.
+
+    Chunked runs write PNG slices only and cannot be checkpointed, so
+    OUTPUT_VOLUME and CHECKPOINT_INTERVAL must be off.
+
+    :param stack_folder: Slice folder, or the folder of a packed volume
+    :param start_index: First slice to track
+    :param end_index: Slice to stop before
+    :param output_directory: Directory for the labelled slices
+    :param chunk_count: Number of chunks, tracked in as many processes
+    :param overlap: Number of slices a chunk is tracked before its own range, at least 1
+    :param records: TrackRecordWriter that receives the records of every slice with global yarn IDs, or None
+    :return: Local ID -> global ID per chunk, 0 for dropped yarns
+    """
+    if OUTPUT_VOLUME:
+        raise ValueError('Chunked tracking writes one PNG per slice; set OUTPUT_VOLUME = False or PARALLEL_CHUNKS = 0')
+    if CHECKPOINT_INTERVAL:
+        raise ValueError('Chunked tracking cannot be checkpointed or resumed; '
+                         'set CHECKPOINT_INTERVAL = 0 or PARALLEL_CHUNKS = 0')
+    if overlap < 1:
+        # Stitching compares two chunks on a slice both have tracked
+        raise ValueError(f'Chunks must overlap by at least one slice to be stitched, got {overlap}')
+    chunks = split_chunks(start_index, end_index, chunk_count, overlap)
+    args = [(stack_folder, seed_index, chunk_start, chunk_end, output_directory, chunk_index == 0, records is not None)
+            for chunk_index, (seed_index, chunk_start, chunk_end) in enumerate(chunks)]
+
+    with Pool(processes=len(chunks)) as pool:
+        results = pool.map(track_chunk, args)
+
+        chunk_ids = [{key: key for key in results[0]['tail']}]
+        for previous, result in zip(results[:-1], results[1:]):
+            chunk_ids.append(stitch_identities(previous['tail'], chunk_ids[-1], result['head']))
+
+        pool.map(relabel_chunk, [(output_directory, result['names'], result['centers'], ids)
+                                 for result, ids in zip(results[1:], chunk_ids[1:])])
+
+    if records is not None:
+        for result, ids in zip(results, chunk_ids):
+            chunk_records = result['records']
+            lookup = np.arange(max(max(ids, default=0), chunk_records['yarn'].max(initial=0)) + 1)
+            lookup[list(ids)] = list(ids.values())
+            chunk_records['yarn'] = lookup[chunk_records['yarn']]
+            records.write(chunk_records[chunk_records['yarn'] > 0])
+    return chunk_ids
+
+
+def check_parallel(stack_folder, start_index, end_index, chunk_count=PARALLEL_CHUNKS, overlap=CHUNK_OVERLAP):
+    """
+    Track a slice range both sequentially and in chunks and report where the outputs differ.
+
+    A chunk starts from its own seed slice, so a yarn that goes stale can carry
+    a different mask than in the sequential run; the yarn IDs and centroids per
+    slice should agree. Both runs write to a temporary directory that is
+    removed afterwards.
+
+    :param stack_folder: Slice folder, or the folder of a packed volume
+    :param start_index: First slice to track
+    :param end_index: Slice to stop before
+    :param chunk_count: Number of chunks of the chunked run
+    :param overlap: Number of slices a chunk is tracked before its own range
+    :return: Names of the slices whose labelled output differs
+    """
+    check_directory = tempfile.mkdtemp(prefix='yarn_check_')
+    try:
+        sequential_directory = os.path.join(check_directory, 'sequential') + os.sep
+        chunked_directory = os.path.join(check_directory, 'chunked') + os.sep
+        os.makedirs(sequential_directory)
+        os.makedirs(chunked_directory)
+
+        input_stack = open_stack(stack_folder)
+        tracker = YarnTracker(input_stack[start_index])
+        sequential_records = []
+        with SliceWriter(sequential_directory, compression=PNG_COMPRESSION) as writer:
+            for frame_index, (current_file, gray_frame) in enumerate(input_stack.iter_slices(start_index, end_index),
+                                                                     start=start_index):
+                writer.write(current_file, tracker.track(gray_frame))
+                sequential_records.append(tracker.track_records(frame_index))
+        sequential_records = np.concatenate(sequential_records)
+
+        with TrackRecordWriter(os.path.join(check_directory, 'chunked_tracks.bin')) as records:
+            track_parallel(stack_folder, start_index, end_index, chunked_directory, chunk_count, overlap,
+                           records=records)
+        chunked_records, _ = load_track_records(os.path.join(check_directory, 'chunked_tracks.bin'))
+
+        differing = []
+        yarn_pixels = 0
+        differing_pixels = 0
+        for name in sorted(os.listdir(sequential_directory)):
+            sequential = cv2.imread(sequential_directory + name, cv2.IMREAD_GRAYSCALE)
+            chunked = cv2.imread(chunked_directory + name, cv2.IMREAD_GRAYSCALE)
+            if chunked is None:
+                chunked = np.zeros_like(sequential)
+            yarn_pixels += np.count_nonzero(sequential)
+            differing_pixels += np.count_nonzero(sequential != chunked)
+            if not np.array_equal(sequential, chunked):
+                differing.append(name)
+
+        print(f'Slices: {end_index - start_index}, differing: {len(differing)} '
+              f'({differing_pixels / max(yarn_pixels, 1):.4%} of the yarn pixels)')
+        print(f'Track records: sequential {len(sequential_records)}, chunked {len(chunked_records)}')
+        print(f'Yarns: sequential {len(np.unique(sequential_records["yarn"]))}, '
+              f'chunked {len(np.unique(chunked_records["yarn"]))}')
+        del chunked_records
+        return differing
+    finally:
+        shutil.rmtree(check_directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    # Reads the packed volume if slice_stack.py has converted the folder, else the PNGs
+    stack_folder = './Tracking/Sample_A_warp'
+    output_directory = './Tracked/'
+
+    start_index = 300
+    end_index = 1381
+
+    parser = argparse.ArgumentParser(description='Track yarn cross-sections through a slice stack.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue after the last checkpoint in the output directory')
+    parser.add_argument('--end', type=int, default=end_index,
+                        help='Slice to stop before; raise it with --resume to extend a finished run')
+    parser.add_argument('--check-parallel', type=int, metavar='SLICES',
+                        help='Track this many slices both sequentially and in PARALLEL_CHUNKS chunks, '
+                             'report where they differ and exit')
+    args = parser.parse_args()
+    end_index = args.end
+    if args.resume and PARALLEL_CHUNKS > 1:
+        parser.error('--resume continues a sequential run from its checkpoint; chunked runs are not '
+                     'checkpointed, set PARALLEL_CHUNKS = 0')
+
+    if args.check_parallel:
+        differing = check_parallel(stack_folder, start_index, min(start_index + args.check_parallel, end_index),
+                                   max(PARALLEL_CHUNKS, 2))
+        if differing:
+            print('Differing slices:', ' '.join(differing))
+        sys.exit(1 if differing else 0)
+
+    sample_name = os.path.basename(os.path.normpath(stack_folder))
+    checkpoint_path = os.path.join(output_directory, f'{sample_name}_checkpoint.npz')
+
+    if PARALLEL_CHUNKS > 1:
+        records = None
+        if TRACK_RECORDS:
+            records = TrackRecordWriter(os.path.join(output_directory, f'{sample_name}_tracks.bin'),
+                                        sample=sample_name, gray_value=GRAY_VALUE)
+        track_parallel(stack_folder, start_index, end_index, output_directory, records=records)
+        if records is not None:
+            records.close()
+    else:
+        input_stack = open_stack(stack_folder)
+        if args.resume:
+            # Continue after the last checkpointed slice with the saved contour library
+            tracker, checkpoint = YarnTracker.load_checkpoint(checkpoint_path)
+            first_index = int(checkpoint['frame_index']) + 1
+            slice_names = checkpoint['slice_names'].tolist()
+            print(f'Resuming {sample_name} at slice {first_index}')
+        else:
+            # Initialize seed image and contour library
+            tracker = YarnTracker(input_stack[start_index])
+            first_index = start_index
+            slice_names = []
+            if OUTPUT_VOLUME and CHECKPOINT_INTERVAL:
+                # The volume and parts of an earlier run would otherwise be merged into this one
+                for _, part_path in label_volume_parts(output_directory, sample_name):
+                    os.remove(part_path)
+                volume_path = os.path.join(output_directory, f'{sample_name}_labels.npz')
+                if os.path.exists(volume_path):
+                    os.remove(volume_path)
+
+        writer = open_output_writer(output_directory, sample_name, first_index)
+
+        records = None
+        if TRACK_RECORDS:
+            records = TrackRecordWriter(os.path.join(output_directory, f'{sample_name}_tracks.bin'),
+                                        append_after=first_index - 1 if args.resume else None,
+                                        sample=sample_name, gray_value=GRAY_VALUE)
+
+        # Main tracking loop; slices are decoded ahead and written behind in the background
+        frame_count = end_index - first_index
+        frame_number = 0
+        start_time = time.time()
+        try:
+            for frame_index, (current_file, gray_frame) in enumerate(
+                    input_stack.iter_slices(first_index, end_index), start=first_index):
+                output_img = tracker.track(gray_frame)
+
+                # Save results
+                if writer is None:
+                    writer = open_output_writer(output_directory, sample_name, frame_index)
+                writer.write(current_file, output_img)
+                slice_names.append(current_file)
+                frame_number += 1
+                if records is not None:
+                    records.write(tracker.track_records(frame_index))
+
+                if CHECKPOINT_INTERVAL and (frame_number % CHECKPOINT_INTERVAL == 0 or frame_index == end_index - 1):
+                    # Only checkpoint slices whose output is on disk; a volume part is complete once closed
+                    if OUTPUT_VOLUME:
+                        writer.close()
+                        writer = None
+                    else:
+                        writer.flush()
+                    tracker.save_checkpoint(checkpoint_path, frame_index=frame_index,
+                                            slice_names=np.array(slice_names))
 
-        # Save results
-        output_filename = output_directory + current_file.split('/')[-1]
-        cv2.imwrite(output_filename, output_img)
+                report_slice(tracker, frame_number, frame_count, output_directory, current_file, start_time)
+        finally:
+            if writer is not None:
+                writer.close()
 
-        print(output_filename)
-        print(non_updated_count)
-        print(non_updated_count_plus)
-        print(non_updated_count_plus2)
\ No newline at end of file
+        if records is not None:
+            records.close()
+        if OUTPUT_VOLUME:
+            if CHECKPOINT_INTERVAL:
+                merge_label_parts(output_directory, sample_name)
+            write_track_table(os.path.join(output_directory, f'{sample_name}_tracks.csv'), tracker, slice_names)
@@ -24,7 +24,7 @@ from detectron2.projects.deeplab import add_deeplab_config
 from detectron2.utils.logger import setup_logger
 
 from maskdino import add_maskdino_config
-from predictor import VisualizationDemo
+from predictor import VisualizationDemo, VolumePredictor
 
 
 # constants
@@ -81,6 +81,14 @@ def get_parser():
     )
     parser.add_argument("--webcam", action="store_true", help="Take inputs from webcam.")
     parser.add_argument("--video-input", help="Path to video file.")
+    parser.add_argument(
+        "--volume",
+        help="A slice folder (or the folder a .vol volume was packed from) to segment in batches; "
+        "results are written to the --output directory.",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=8, help="Number of slices per forward call with --volume"
+    )
     parser.add_argument(
         "--input",
         nargs="+",
@@ -134,6 +142,17 @@ if __name__ == "__main__":
 
     cfg = setup_cfg(args)
 
+    if args.volume:
+        assert args.output, "Please specify an output directory with --output"
+        start_time = time.time()
+        num_slices = VolumePredictor(cfg, args.batch_size).run_on_stack(
+            args.volume, args.output, args.confidence_threshold
+        )
+        logger.info(
+            "{}: segmented {} slices in {:.2f}s".format(args.volume, num_slices, time.time() - start_time)
+        )
+        sys.exit(0)
+
     demo = VisualizationDemo(cfg)
 
     if args.input:
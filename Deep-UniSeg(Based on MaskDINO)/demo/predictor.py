@@ -2,17 +2,28 @@
 # Copied from: https://github.com/facebookresearch/detectron2/blob/master/demo/predictor.py
 import atexit
 import bisect
+import csv
 import multiprocessing as mp
+import os
+import sys
 from collections import deque
+from itertools import islice
 
 import cv2
+import numpy as np
 import torch
 
+import detectron2.data.transforms as T
+from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.data import MetadataCatalog
 from detectron2.engine.defaults import DefaultPredictor
+from detectron2.modeling import build_model
 from detectron2.utils.video_visualizer import VideoVisualizer
 from detectron2.utils.visualizer import ColorMode, Visualizer
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from slice_stack import open_stack, SliceWriter
+
 
 class VisualizationDemo(object):
     def __init__(self, cfg, instance_mode=ColorMode.IMAGE, parallel=False):
@@ -128,6 +139,114 @@ class VisualizationDemo(object):
                 yield process_predictions(frame, self.predictor(frame))
 
 
+class VolumePredictor(object):
+    """
+    Segment a slice stack with several slices per forward call.
+
+    :class:`DefaultPredictor` runs the model on one image at a time. Here
+    consecutive slices are batched instead; slices of a stack share their
+    size, so the padded batch wastes no pixels. Results are written by
+    background threads while the next batch runs.
+    """
+
+    def __init__(self, cfg, batch_size=8):
+        """
+        Args:
+            cfg (CfgNode):
+            batch_size (int): number of slices per forward call
+        """
+        self.cfg = cfg.clone()
+        self.model = build_model(self.cfg)
+        self.model.eval()
+        DetectionCheckpointer(self.model).load(cfg.MODEL.WEIGHTS)
+
+        self.aug = T.ResizeShortestEdge(
+            [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+        )
+        self.input_format = cfg.INPUT.FORMAT
+        assert self.input_format in ["RGB", "BGR"], self.input_format
+        self.batch_size = batch_size
+        self.cpu_device = torch.device("cpu")
+
+    def __call__(self, images):
+        """
+        Args:
+            images (list[np.ndarray]): grayscale slices of shape (H, W), or images of shape
+                (H, W, C) in BGR order.
+        Returns:
+            list[dict]: the output of the model for each image.
+        """
+        inputs = []
+        for image in images:
+            if image.ndim == 2:
+                image = cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_GRAY2BGR)
+            if self.input_format == "RGB":
+                image = image[:, :, ::-1]
+            height, width = image.shape[:2]
+            image = self.aug.get_transform(image).apply_image(image)
+            image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+            inputs.append({"image": image, "height": height, "width": width})
+        with torch.no_grad():
+            return self.model(inputs)
+
+    def run_on_stack(self, folder, output_folder, confidence_threshold=0.5):
+        """
+        Segment every slice of a stack and stream the results to disk.
+
+        Semantic segmentation is written as one class-index PNG per slice to
+        `output_folder/sem_seg`. Instances above the threshold are drawn as one
+        uint16 instance-id PNG per slice to `output_folder/instances`. Their
+        class, score, box and area go to `output_folder/instances.csv`.
+
+        Args:
+            folder (str): slice folder; its packed volume is used when up to date
+            output_folder (str): directory for the results
+            confidence_threshold (float): minimum score of the instances written
+        Returns:
+            int: number of slices segmented
+        """
+        stack = open_stack(folder)
+        sem_seg_folder = os.path.join(output_folder, "sem_seg")
+        instance_folder = os.path.join(output_folder, "instances")
+        os.makedirs(sem_seg_folder, exist_ok=True)
+        os.makedirs(instance_folder, exist_ok=True)
+
+        count = 0
+        slices = stack.iter_slices()
+        with SliceWriter(sem_seg_folder) as sem_seg_writer, SliceWriter(instance_folder) as instance_writer, \
+                open(os.path.join(output_folder, "instances.csv"), "w", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["Slice", "File Name", "Instance", "Class", "Score", "X0", "Y0", "X1", "Y1", "Area"])
+            while True:
+                batch = list(islice(slices, self.batch_size))
+                if not batch:
+                    break
+                names, images = zip(*batch)
+                for name, predictions in zip(names, self(images)):
+                    file_name = os.path.splitext(name)[0] + ".png"
+                    if "sem_seg" in predictions:
+                        sem_seg = predictions["sem_seg"].argmax(dim=0).to(torch.uint8)
+                        sem_seg_writer.write(file_name, sem_seg.to(self.cpu_device).numpy())
+                    if "instances" in predictions:
+                        instances = predictions["instances"]
+                        instances = instances[instances.scores >= confidence_threshold]
+                        instances = instances[instances.scores.argsort(descending=True)].to(self.cpu_device)
+                        masks = instances.pred_masks.numpy() > 0
+                        labels = np.zeros(instances.image_size, dtype=np.uint16)
+                        # draw the best instances last so they win where masks overlap
+                        for i in range(len(instances) - 1, -1, -1):
+                            labels[masks[i]] = i + 1
+                        instance_writer.write(file_name, labels)
+                        for i, (box, score, pred_class, area) in enumerate(zip(
+                            instances.pred_boxes.tensor.tolist(), instances.scores.tolist(),
+                            instances.pred_classes.tolist(), masks.sum(axis=(1, 2)).tolist(),
+                        )):
+                            writer.writerow([count, name, i + 1, pred_class, "{:.4f}".format(score)]
+                                            + ["{:.1f}".format(v) for v in box] + [area])
+                    count += 1
+        return count
+
+
 class AsyncPredictor:
     """
     A predictor that runs the model asynchronously, possibly on >1 GPUs.
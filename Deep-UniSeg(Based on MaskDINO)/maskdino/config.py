@@ -95,6 +95,14 @@ def add_maskdino_config(cfg):
     cfg.MODEL.MaskDINO.TEST.SEM_SEG_POSTPROCESSING_BEFORE_INFERENCE = False
     cfg.MODEL.MaskDINO.TEST.PANO_TRANSFORM_EVAL = True
     cfg.MODEL.MaskDINO.TEST.PANO_TEMPERATURE = 0.06
+    # compute the semantic scores at mask feature resolution and upsample the C class maps instead of the Q query
+    # masks; much cheaper, but upsamples probabilities instead of logits so results differ slightly
+    cfg.MODEL.MaskDINO.TEST.SEMANTIC_LOW_RES_INFERENCE = False
+    # tiled inference for large slices: run overlapping TILE_SIZE crops instead of the whole image (0 disables);
+    # semantic logits are blended across the overlap and instances merged by NMS, panoptic is not tiled
+    cfg.MODEL.MaskDINO.TEST.TILE_SIZE = 0
+    cfg.MODEL.MaskDINO.TEST.TILE_OVERLAP = 128
+    cfg.MODEL.MaskDINO.TEST.TILE_NMS_THRESHOLD = 0.5
     # cfg.MODEL.MaskDINO.TEST.EVAL_FLAG = 1
 
     # Sometimes `backbone.size_divisibility` is set to 0 for some backbone (e.g. ResNet)
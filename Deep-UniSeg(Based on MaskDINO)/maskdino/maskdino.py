@@ -3,6 +3,7 @@
 # Licensed under the Apache License, Version 2.0 [see LICENSE for details]
 # ------------------------------------------------------------------------
 # Modified from Mask2Former https://github.com/facebookresearch/Mask2Former by Feng Li and Hao Zhang.
+from functools import partial
 from typing import Tuple
 
 import torch
@@ -11,6 +12,7 @@ from torch.nn import functional as F
 
 from detectron2.config import configurable
 from detectron2.data import MetadataCatalog
+from detectron2.layers import batched_nms
 from detectron2.modeling import META_ARCH_REGISTRY, build_backbone, build_sem_seg_head
 from detectron2.modeling.backbone import Backbone
 from detectron2.modeling.postprocessing import sem_seg_postprocess
@@ -22,6 +24,33 @@ from .modeling.matcher import HungarianMatcher
 from .utils import box_ops
 
 
+def tile_starts(length, tile_length, overlap):
+    """
+    Start offsets of overlapping tiles that cover [0, length); the last tile ends at the border.
+    """
+    if length <= tile_length:
+        return [0]
+    starts = list(range(0, length - tile_length, max(1, tile_length - overlap)))
+    starts.append(length - tile_length)
+    return starts
+
+
+def tile_ramp(length, start, tile_length, overlap, device):
+    """
+    1D blending weight of a tile: ramps up over the overlap on sides that face another tile and stays 1
+    towards the image border, so that overlapping predictions fade into each other without seams.
+    """
+    weight = torch.ones(tile_length, device=device)
+    ramp_length = min(overlap, tile_length // 2)
+    if ramp_length > 0:
+        ramp = torch.arange(1, ramp_length + 1, device=device, dtype=torch.float) / (ramp_length + 1)
+        if start > 0:
+            weight[:ramp_length] = ramp
+        if start + tile_length < length:
+            weight[-ramp_length:] = ramp.flip(0)
+    return weight
+
+
 @META_ARCH_REGISTRY.register()
 class MaskDINO(nn.Module):
     """
@@ -53,6 +82,10 @@ class MaskDINO(nn.Module):
         focus_on_box: bool = False,
         transform_eval: bool = False,
         semantic_ce_loss: bool = False,
+        tile_size: int = 0,
+        tile_overlap: int = 0,
+        tile_nms_threshold: float = 0.5,
+        semantic_low_res_inference: bool = False,
     ):
         """
         Args:
@@ -79,6 +112,12 @@ class MaskDINO(nn.Module):
             test_topk_per_image: int, instance segmentation parameter, keep topk instances per image
             transform_eval: transform sigmoid score into softmax score to make score sharper
             semantic_ce_loss: whether use cross-entroy loss in classification
+            tile_size: int, run inference on overlapping crops of this size instead of the whole
+                image, so that peak memory is bounded by the tile; 0 disables tiling
+            tile_overlap: int, overlap between neighbouring tiles in pixels
+            tile_nms_threshold: float, box IoU above which instances from different tiles are merged
+            semantic_low_res_inference: bool, combine classes and masks at mask feature resolution and
+                upsample the class maps instead of upsampling every query mask first
         """
         super().__init__()
         self.backbone = backbone
@@ -107,6 +146,19 @@ class MaskDINO(nn.Module):
         self.focus_on_box = focus_on_box
         self.transform_eval = transform_eval
         self.semantic_ce_loss = semantic_ce_loss
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_nms_threshold = tile_nms_threshold
+        self.semantic_low_res_inference = semantic_low_res_inference
+        # class index -> whether it is a "thing" class, the last entry stands for "no object"
+        is_thing = torch.zeros(self.sem_seg_head.num_classes + 1, dtype=torch.bool)
+        thing_ids = list(getattr(self.metadata, "thing_dataset_id_to_contiguous_id", {}).values())
+        is_thing[thing_ids] = True
+        self.register_buffer("is_thing", is_thing, False)
+        # class label of each entry of the flattened (num_queries x num_classes) score matrix
+        self.register_buffer(
+            "query_labels", torch.arange(self.sem_seg_head.num_classes).repeat(self.num_queries), False
+        )
 
         if not self.semantic_on:
             assert self.sem_seg_postprocess_before_inference
@@ -212,7 +264,11 @@ class MaskDINO(nn.Module):
             "focus_on_box": cfg.MODEL.MaskDINO.TEST.TEST_FOUCUS_ON_BOX,
             "transform_eval": cfg.MODEL.MaskDINO.TEST.PANO_TRANSFORM_EVAL,
             "pano_temp": cfg.MODEL.MaskDINO.TEST.PANO_TEMPERATURE,
-            "semantic_ce_loss": cfg.MODEL.MaskDINO.TEST.SEMANTIC_ON and cfg.MODEL.MaskDINO.SEMANTIC_CE_LOSS and not cfg.MODEL.MaskDINO.TEST.PANOPTIC_ON
+            "semantic_ce_loss": cfg.MODEL.MaskDINO.TEST.SEMANTIC_ON and cfg.MODEL.MaskDINO.SEMANTIC_CE_LOSS and not cfg.MODEL.MaskDINO.TEST.PANOPTIC_ON,
+            "tile_size": cfg.MODEL.MaskDINO.TEST.TILE_SIZE,
+            "tile_overlap": cfg.MODEL.MaskDINO.TEST.TILE_OVERLAP,
+            "tile_nms_threshold": cfg.MODEL.MaskDINO.TEST.TILE_NMS_THRESHOLD,
+            "semantic_low_res_inference": cfg.MODEL.MaskDINO.TEST.SEMANTIC_LOW_RES_INFERENCE,
         }
 
     @property
@@ -245,6 +301,9 @@ class MaskDINO(nn.Module):
                     segments_info (list[dict]): Describe each segment in `panoptic_seg`.
                         Each dict contains keys "id", "category_id", "isthing".
         """
+        if not self.training and self.tile_size > 0 and not self.panoptic_on:
+            return [self.tiled_inference(x) for x in batched_inputs]
+
         images = [x["image"].to(self.device) for x in batched_inputs]
         images = [(x - self.pixel_mean) / self.pixel_std for x in images]
         images = ImageList.from_tensors(images, self.size_divisibility)
@@ -278,13 +337,8 @@ class MaskDINO(nn.Module):
             mask_cls_results = outputs["pred_logits"]
             mask_pred_results = outputs["pred_masks"]
             mask_box_results = outputs["pred_boxes"]
-            # upsample masks
-            mask_pred_results = F.interpolate(
-                mask_pred_results,
-                size=(images.tensor.shape[-2], images.tensor.shape[-1]),
-                mode="bilinear",
-                align_corners=False,
-            )
+            # masks stay at mask feature resolution; each inference upsamples only the queries it keeps
+            padded_size = images.tensor.shape[-2:]
 
             del outputs
 
@@ -295,27 +349,33 @@ class MaskDINO(nn.Module):
                 height = input_per_image.get("height", image_size[0])  # real size
                 width = input_per_image.get("width", image_size[1])
                 processed_results.append({})
-                new_size = mask_pred_result.shape[-2:]  # padded size (divisible to 32)
-
-
+                new_size = padded_size  # padded size (divisible to 32)
+                upsample = partial(
+                    self.upsample_masks, padded_size=new_size, image_size=image_size, height=height, width=width,
+                    postprocess=self.sem_seg_postprocess_before_inference,
+                )
                 if self.sem_seg_postprocess_before_inference:
-                    mask_pred_result = retry_if_cuda_oom(sem_seg_postprocess)(
-                        mask_pred_result, image_size, height, width
-                    )
                     mask_cls_result = mask_cls_result.to(mask_pred_result)
                     # mask_box_result = mask_box_result.to(mask_pred_result)
                     # mask_box_result = self.box_postprocess(mask_box_result, height, width)
 
                 # semantic segmentation inference
                 if self.semantic_on:
-                    r = retry_if_cuda_oom(self.semantic_inference)(mask_cls_result, mask_pred_result)
-                    if not self.sem_seg_postprocess_before_inference:
-                        r = retry_if_cuda_oom(sem_seg_postprocess)(r, image_size, height, width)
+                    if self.semantic_low_res_inference:
+                        r = retry_if_cuda_oom(self.semantic_inference)(mask_cls_result, mask_pred_result)
+                        r = self.upsample_masks(r, new_size, image_size, height, width, postprocess=True)
+                    else:
+                        # every query is needed here, so upsample all of them once and share them below
+                        mask_pred_result = upsample(mask_pred_result)
+                        upsample = None
+                        r = retry_if_cuda_oom(self.semantic_inference)(mask_cls_result, mask_pred_result)
+                        if not self.sem_seg_postprocess_before_inference:
+                            r = retry_if_cuda_oom(sem_seg_postprocess)(r, image_size, height, width)
                     processed_results[-1]["sem_seg"] = r
 
                 # panoptic segmentation inference
                 if self.panoptic_on:
-                    panoptic_r = retry_if_cuda_oom(self.panoptic_inference)(mask_cls_result, mask_pred_result)
+                    panoptic_r = retry_if_cuda_oom(self.panoptic_inference)(mask_cls_result, mask_pred_result, upsample)
                     processed_results[-1]["panoptic_seg"] = panoptic_r
 
                 # instance segmentation inference
@@ -326,11 +386,132 @@ class MaskDINO(nn.Module):
                     width = new_size[1]/image_size[1]*width
                     mask_box_result = self.box_postprocess(mask_box_result, height, width)
 
-                    instance_r = retry_if_cuda_oom(self.instance_inference)(mask_cls_result, mask_pred_result, mask_box_result)
+                    instance_r = retry_if_cuda_oom(self.instance_inference)(
+                        mask_cls_result, mask_pred_result, mask_box_result, upsample
+                    )
                     processed_results[-1]["instances"] = instance_r
 
             return processed_results
 
+    def upsample_masks(self, masks, padded_size, image_size, height, width, postprocess):
+        """
+        Upsample masks or class maps from mask feature resolution to the padded input size.
+
+        Args:
+            masks: (N, h, w) tensor
+            padded_size: padded size of the batch
+            image_size: size of the image inside the padded batch
+            height, width: output size
+            postprocess: whether to also crop away the padding and resize to the output size
+        Returns:
+            Tensor: (N, H, W) upsampled masks
+        """
+        if masks.shape[0] == 0:
+            size = (int(height), int(width)) if postprocess else tuple(padded_size)
+            return masks.new_zeros((0,) + size)
+        masks = F.interpolate(masks[None], size=padded_size, mode="bilinear", align_corners=False)[0]
+        if postprocess:
+            masks = retry_if_cuda_oom(sem_seg_postprocess)(masks, image_size, height, width)
+        return masks
+
+    def tiled_inference(self, input_per_image):
+        """
+        Run inference on overlapping tiles of one image and merge the tile predictions.
+
+        Only one tile's num_queries x tile_size x tile_size mask logits exist at a time. Semantic
+        scores are blended with tile_ramp weights; instances are shifted to image coordinates and
+        deduplicated across tiles with class-wise NMS, where instances cut by an inner tile border
+        rank below complete detections of the same object from the neighbouring tile.
+
+        Args:
+            input_per_image: one item of the `batched_inputs` of :meth:`forward`
+        Returns:
+            dict: the same "sem_seg" and "instances" results :meth:`forward` returns for the image
+        """
+        image = input_per_image["image"].to(self.device)
+        image = (image - self.pixel_mean) / self.pixel_std
+        image_size = tuple(image.shape[-2:])
+        height = input_per_image.get("height", image_size[0])
+        width = input_per_image.get("width", image_size[1])
+        tile_h = min(self.tile_size, image_size[0])
+        tile_w = min(self.tile_size, image_size[1])
+
+        semseg, semseg_weight = None, None
+        kept = None  # merged instance fields: boxes, scores, nms scores, classes, tile masks, offsets
+        for y in tile_starts(image_size[0], tile_h, self.tile_overlap):
+            for x in tile_starts(image_size[1], tile_w, self.tile_overlap):
+                tile = ImageList.from_tensors([image[:, y:y + tile_h, x:x + tile_w]], self.size_divisibility)
+                outputs, _ = self.sem_seg_head(self.backbone(tile.tensor))
+                padded_size = tile.tensor.shape[-2:]
+                mask_pred = F.interpolate(
+                    outputs["pred_masks"], size=padded_size, mode="bilinear", align_corners=False,
+                )[0, :, :tile_h, :tile_w]
+                mask_cls = outputs["pred_logits"][0].to(mask_pred)
+                mask_box = outputs["pred_boxes"][0].to(mask_pred)
+                del outputs
+
+                if self.semantic_on:
+                    r = self.semantic_inference(mask_cls, mask_pred)
+                    weight = (tile_ramp(image_size[0], y, tile_h, self.tile_overlap, self.device)[:, None]
+                              * tile_ramp(image_size[1], x, tile_w, self.tile_overlap, self.device)[None, :])
+                    if semseg is None:
+                        semseg = r.new_zeros((r.shape[0],) + image_size)
+                        semseg_weight = r.new_zeros(image_size)
+                    semseg[:, y:y + tile_h, x:x + tile_w] += r * weight
+                    semseg_weight[y:y + tile_h, x:x + tile_w] += weight
+
+                if self.instance_on:
+                    boxes = self.box_postprocess(mask_box, padded_size[0], padded_size[1])
+                    tile_r = self.instance_inference(mask_cls, mask_pred, boxes)
+                    boxes = tile_r.pred_boxes.tensor + boxes.new_tensor([x, y, x, y])
+                    # instances touching a border shared with another tile are probably cut off
+                    cut = ((x > 0) & (boxes[:, 0] <= x + 1)) | ((y > 0) & (boxes[:, 1] <= y + 1))
+                    cut |= (x + tile_w < image_size[1]) & (boxes[:, 2] >= x + tile_w - 1)
+                    cut |= (y + tile_h < image_size[0]) & (boxes[:, 3] >= y + tile_h - 1)
+                    fields = [
+                        boxes,
+                        tile_r.scores,
+                        tile_r.scores * (1 - 0.5 * cut.to(tile_r.scores)),
+                        tile_r.pred_classes,
+                        tile_r.pred_masks > 0,
+                        boxes.new_tensor([y, x]).long().expand(len(boxes), 2),
+                    ]
+                    if kept is not None:
+                        fields = [torch.cat([a, b]) for a, b in zip(kept, fields)]
+                    keep = batched_nms(fields[0], fields[2], fields[3], self.tile_nms_threshold)
+                    kept = [field[keep[:self.test_topk_per_image]] for field in fields]
+
+        processed_results = {}
+        if self.semantic_on:
+            semseg = semseg / semseg_weight.clamp(min=1e-6)
+            processed_results["sem_seg"] = retry_if_cuda_oom(sem_seg_postprocess)(semseg, image_size, height, width)
+
+        if self.instance_on:
+            boxes, scores, _, classes, tile_masks, offsets = kept
+            height, width = int(height), int(width)
+            scale_y, scale_x = height / image_size[0], width / image_size[1]
+            # paste each tile mask straight into the output resolution; only its own tile region is resized.
+            # The masks stay boolean: a float (N, H, W) tensor of a whole slice would take four times the memory
+            masks = torch.zeros((len(boxes), height, width), dtype=torch.bool, device=self.device)
+            for mask, tile_mask, (y, x) in zip(masks, tile_masks, offsets.tolist()):
+                y0, y1 = round(y * scale_y), round((y + tile_h) * scale_y)
+                x0, x1 = round(x * scale_x), round((x + tile_w) * scale_x)
+                if y1 <= y0 or x1 <= x0:
+                    continue
+                if (y1 - y0, x1 - x0) != (tile_h, tile_w):
+                    tile_mask = F.interpolate(
+                        tile_mask[None, None].float(), size=(y1 - y0, x1 - x0), mode="bilinear", align_corners=False,
+                    )[0, 0] > 0.5
+                mask[y0:y1, x0:x1] = tile_mask
+            result = Instances((height, width))
+            result.pred_masks = masks
+            result.pred_boxes = Boxes(boxes * boxes.new_tensor([width, height, width, height])
+                                      / boxes.new_tensor([image_size[1], image_size[0], image_size[1], image_size[0]]))
+            result.scores = scores
+            result.pred_classes = classes
+            processed_results["instances"] = result
+        return processed_results
+
     def prepare_targets(self, targets, images):
         h_pad, w_pad = images.tensor.shape[-2:]
         new_targets = []
@@ -390,14 +571,14 @@ class MaskDINO(nn.Module):
             semseg = torch.einsum("qc,qhw->chw", mask_cls, mask_pred)
             return semseg
 
-    def panoptic_inference(self, mask_cls, mask_pred):
+    def panoptic_inference(self, mask_cls, mask_pred, upsample=None):
+        # mask_pred is at mask feature resolution when `upsample` is given, which is then applied to the kept queries
         # As we use focal loss in training, evaluate with sigmoid. As sigmoid is mainly for detection and not sharp
         # enough for semantic and panoptic segmentation, we additionally use use softmax with a temperature to
         # make the score sharper.
         prob = 0.5
         T = self.pano_temp
         scores, labels = mask_cls.sigmoid().max(-1)
-        mask_pred = mask_pred.sigmoid()
         keep = labels.ne(self.sem_seg_head.num_classes) & (scores > self.object_mask_threshold)
         # added process
         if self.transform_eval:
@@ -405,6 +586,9 @@ class MaskDINO(nn.Module):
         cur_scores = scores[keep]
         cur_classes = labels[keep]
         cur_masks = mask_pred[keep]
+        if upsample is not None:
+            cur_masks = upsample(cur_masks)
+        cur_masks = cur_masks.sigmoid()
         cur_prob_masks = cur_scores.view(-1, 1, 1) * cur_masks
 
         h, w = cur_masks.shape[-2:]
@@ -419,56 +603,67 @@ class MaskDINO(nn.Module):
         else:
             # take argmax
             cur_mask_ids = cur_prob_masks.argmax(0)
+            num_kept = cur_classes.shape[0]
+            confident = cur_masks >= prob
+            # each pixel belongs to its argmax query and is painted where that query's own mask is confident
+            painted = confident.gather(0, cur_mask_ids[None])[0]
+            mask_areas = torch.bincount(cur_mask_ids.flatten(), minlength=num_kept)
+            original_areas = confident.flatten(1).sum(1)
+            painted_areas = torch.bincount(cur_mask_ids[painted], minlength=num_kept)
+            valid = (mask_areas > 0) & (original_areas > 0) & (painted_areas > 0)
+            valid &= mask_areas.float() / original_areas.clamp(min=1).float() >= self.overlap_threshold
+            # a single device sync for the bookkeeping below
+            valid, classes, isthing = torch.stack(
+                [valid.long(), cur_classes.long(), self.is_thing[cur_classes].long()]
+            ).tolist()
+
+            segment_ids = [0] * num_kept
             stuff_memory_list = {}
-            for k in range(cur_classes.shape[0]):
-                pred_class = cur_classes[k].item()
-                isthing = pred_class in self.metadata.thing_dataset_id_to_contiguous_id.values()
-                mask_area = (cur_mask_ids == k).sum().item()
-                original_area = (cur_masks[k] >= prob).sum().item()
-                mask = (cur_mask_ids == k) & (cur_masks[k] >= prob)
-
-                if mask_area > 0 and original_area > 0 and mask.sum().item() > 0:
-                    if mask_area / original_area < self.overlap_threshold:
+            for k in range(num_kept):
+                if not valid[k]:
+                    continue
+                pred_class = classes[k]
+
+                # merge stuff regions
+                if not isthing[k]:
+                    if pred_class in stuff_memory_list:
+                        segment_ids[k] = stuff_memory_list[pred_class]
                         continue
-
-                    # merge stuff regions
-                    if not isthing:
-                        if int(pred_class) in stuff_memory_list.keys():
-                            panoptic_seg[mask] = stuff_memory_list[int(pred_class)]
-                            continue
-                        else:
-                            stuff_memory_list[int(pred_class)] = current_segment_id + 1
-
-                    current_segment_id += 1
-                    panoptic_seg[mask] = current_segment_id
-
-                    segments_info.append(
-                        {
-                            "id": current_segment_id,
-                            "isthing": bool(isthing),
-                            "category_id": int(pred_class),
-                        }
-                    )
-
+                    else:
+                        stuff_memory_list[pred_class] = current_segment_id + 1
+
+                current_segment_id += 1
+                segment_ids[k] = current_segment_id
+
+                segments_info.append(
+                    {
+                        "id": current_segment_id,
+                        "isthing": bool(isthing[k]),
+                        "category_id": pred_class,
+                    }
+                )
+
+            segment_ids = torch.tensor(segment_ids, dtype=torch.int32, device=panoptic_seg.device)
+            panoptic_seg = torch.where(painted, segment_ids[cur_mask_ids], panoptic_seg)
             return panoptic_seg, segments_info
 
-    def instance_inference(self, mask_cls, mask_pred, mask_box_result):
-        # mask_pred is already processed to have the same shape as original input
-        image_size = mask_pred.shape[-2:]
+    def instance_inference(self, mask_cls, mask_pred, mask_box_result, upsample=None):
+        # mask_pred is already processed to have the same shape as original input, or is at mask feature
+        # resolution when `upsample` is given, which is then applied to the selected queries only
         scores = mask_cls.sigmoid()  # [100, 80]
-        labels = torch.arange(self.sem_seg_head.num_classes, device=self.device).unsqueeze(0).repeat(self.num_queries, 1).flatten(0, 1)
         scores_per_image, topk_indices = scores.flatten(0, 1).topk(self.test_topk_per_image, sorted=False)  # select 100
-        labels_per_image = labels[topk_indices]
+        labels_per_image = self.query_labels[topk_indices]
         topk_indices = topk_indices // self.sem_seg_head.num_classes
         mask_pred = mask_pred[topk_indices]
         # if this is panoptic segmentation, we only keep the "thing" classes
         if self.panoptic_on:
-            keep = torch.zeros_like(scores_per_image).bool()
-            for i, lab in enumerate(labels_per_image):
-                keep[i] = lab in self.metadata.thing_dataset_id_to_contiguous_id.values()
+            keep = self.is_thing[labels_per_image]
             scores_per_image = scores_per_image[keep]
             labels_per_image = labels_per_image[keep]
             mask_pred = mask_pred[keep]
+        if upsample is not None:
+            mask_pred = upsample(mask_pred)
+        image_size = mask_pred.shape[-2:]
         result = Instances(image_size)
         # mask (before sigmoid)
         result.pred_masks = (mask_pred > 0).float()
@@ -80,19 +80,20 @@ class SemanticSegmentorWithTTA(nn.Module):
 
         final_predictions = None
         count_predictions = 0
-        for input, tfm in zip(augmented_inputs, tfms):
-            count_predictions += 1
+        for start in range(0, len(augmented_inputs), self.batch_size):
+            batch_inputs = augmented_inputs[start:start + self.batch_size]
+            batch_tfms = tfms[start:start + self.batch_size]
             with torch.no_grad():
+                outputs = self.model(batch_inputs)
+            for output, tfm in zip(outputs, batch_tfms):
+                count_predictions += 1
+                predictions = output.pop("sem_seg")
+                if any(isinstance(t, HFlipTransform) for t in tfm.transforms):
+                    predictions = predictions.flip(dims=[2])
                 if final_predictions is None:
-                    if any(isinstance(t, HFlipTransform) for t in tfm.transforms):
-                        final_predictions = self.model([input])[0].pop("sem_seg").flip(dims=[2])
-                    else:
-                        final_predictions = self.model([input])[0].pop("sem_seg")
+                    final_predictions = predictions
                 else:
-                    if any(isinstance(t, HFlipTransform) for t in tfm.transforms):
-                        final_predictions += self.model([input])[0].pop("sem_seg").flip(dims=[2])
-                    else:
-                        final_predictions += self.model([input])[0].pop("sem_seg")
+                    final_predictions += predictions
 
         final_predictions = final_predictions / count_predictions
         return {"sem_seg": final_predictions}
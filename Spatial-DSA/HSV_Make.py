@@ -1,49 +1,46 @@
-import cv2
 import numpy as np
 import csv
 import os
-from concurrent.futures import ThreadPoolExecutor
+import sys
+from multiprocessing import Pool, cpu_count
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from slice_stack import open_stack
+from yarn_geometry import label_statistics
 
-def calculate_centroid(img, gray_value):
+# Configuration parameters
+WORKERS = cpu_count()  # Worker processes; 1 processes the slices in this process
+CHUNK_SIZE = 16  # Consecutive slices each worker reads and processes per task
+
+
+def calculate_centroids(img, gray_values):
     """
-    Calculate the centroid position of the target with the specified gray value along the Y-axis.
+    Calculate the centroid positions of all targets with the specified gray values along the Y-axis.
 
     :param img: Input image (grayscale)
-    :param gray_value: Target gray value
-    :return: Centroid position (Y-axis coordinate)
+    :param gray_values: Target gray values
+    :return: Centroid positions (Y-axis coordinates), 0 for targets without pixels
     """
-    # Create a mask to filter pixels with the specified gray value
-    mask = (img == gray_value)
-    coords = np.argwhere(mask)  # Get coordinates of all pixels in the mask
-    if coords.size > 0:  # If target pixels exist
-        centroid_y = int(np.mean(coords[:, 0]))  # Calculate the Y-axis centroid
-    else:
-        centroid_y = 0  # Return 0 if no target pixels are found
-    return centroid_y
+    # One pass over the slice for all gray values instead of one mask per value
+    counts, centroids, _ = label_statistics(img, gray_values)
+    return [int(centroid_y) if count > 0 else 0 for count, centroid_y in zip(counts, centroids[:, 1])]
 
 
-def process_image(image_path, gray_values):
+def process_image(image_path, img, gray_values):
     """
     Process a single image to calculate the centroid positions of specified gray values.
 
     :param image_path: Path to the image file
+    :param img: Decoded image (grayscale)
     :param gray_values: List of gray values to calculate centroids for
     :return: A list containing the image name and centroid positions
     """
     try:
-        # Read the image and convert it to grayscale
-        img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        if img is None:
-            raise FileNotFoundError(f"Failed to read image file: {image_path}")
-
         # Initialize the result list with the image name
         row = [os.path.basename(image_path)]
 
         # Calculate the centroid position for each gray value
-        for gray_value in gray_values:
-            centroid_y = calculate_centroid(img, gray_value)
-            row.append(centroid_y)
+        row.extend(calculate_centroids(img, gray_values))
 
         return row
 
@@ -52,6 +49,50 @@ def process_image(image_path, gray_values):
         return None
 
 
+def process_chunk(args):
+    """
+    Read and process a range of consecutive slices in a worker process.
+
+    The worker opens the stack itself, so only slice ranges and result rows
+    cross process boundaries, never decoded images.
+
+    :param args: Tuple of (image folder, first slice index, slice index to stop before, gray values)
+    :return: List of result rows, in slice order
+    """
+    image_folder, start, end, gray_values = args
+    image_stack = open_stack(image_folder)
+    return [process_image(image_path, img, gray_values)
+            for image_path, img in image_stack.iter_slices(start, end, skip_errors=True)]
+
+
+def process_stack(image_folder, gray_values, workers=WORKERS, chunk_size=CHUNK_SIZE):
+    """
+    Process every slice of a stack and yield the result rows in slice order as they complete.
+
+    With several workers, chunks of slices are processed in a process pool;
+    imap hands back the chunks in order, so rows are streamed out without
+    collecting the whole stack first.
+
+    :param image_folder: Slice folder, or the folder of a packed volume
+    :param gray_values: List of gray values to calculate centroids for
+    :param workers: Number of worker processes
+    :param chunk_size: Number of consecutive slices per task
+    :return: Generator of result rows (None for slices that failed)
+    """
+    image_stack = open_stack(image_folder)
+    if workers <= 1:
+        # Process images in slice order while the next ones are decoded in the background
+        for image_path, img in image_stack.iter_slices(skip_errors=True):
+            yield process_image(image_path, img, gray_values)
+        return
+
+    chunks = [(image_folder, start, min(start + chunk_size, len(image_stack)), gray_values)
+              for start in range(0, len(image_stack), chunk_size)]
+    with Pool(processes=workers) as pool:
+        for rows in pool.imap(process_chunk, chunks):
+            yield from rows
+
+
 def main():
     # Set the path to the image folder
     image_folder = './Yarns/Sample_F_weft'
@@ -59,18 +100,14 @@ def main():
     # Get the folder name
     folder_name = os.path.basename(image_folder)
 
-    # Get all image file names
-    image_files = [os.path.join(image_folder, f) for f in os.listdir(image_folder) if
-                   f.endswith('.png') or f.endswith('.jpg')]
+    # Open the slice stack, from its packed volume if one exists
+    image_stack = open_stack(image_folder)
 
-    if not image_files:
+    if len(image_stack) == 0:
         raise FileNotFoundError(f"No image files found in: {image_folder}")
 
     # Get all target gray values
-    first_image = image_files[int(len(image_files)/2)]
-    img = cv2.imread(first_image, cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        raise FileNotFoundError(f"Failed to read image file: {first_image}")
+    img = image_stack[int(len(image_stack)/2)]
 
     gray_values = np.unique(img)[
         np.unique(img) >= 181]  # Filter weft yarn gray values >= 181
@@ -84,13 +121,10 @@ def main():
         header = ['Image Name'] + [f'Yarn {i + 1}' for i in range(len(gray_values))]
         writer.writerow(header)
 
-        # Process images using multithreading
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(process_image, image_path, gray_values) for image_path in image_files]
-            for future in futures:
-                result = future.result()
-                if result:  # Write the result if processing is successful
-                    writer.writerow(result)
+        # Rows arrive in slice order and are written as soon as they are ready
+        for result in process_stack(image_folder, gray_values):
+            if result:  # Write the result if processing is successful
+                writer.writerow(result)
 
 
 if __name__ == "__main__":
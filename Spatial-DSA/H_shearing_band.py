@@ -1,7 +1,9 @@
 import pandas as pd
-import numpy as np
-from scipy.interpolate import UnivariateSpline
-from math import sqrt
+from band_detection import detect_mutation_ranges, mutation_distances
+from curve_fitting import smooth_columns
+
+# Configuration parameters
+BATCH_SMOOTHING = False  # Smooth all columns in one solve on shared knots instead of one adaptive spline each
 
 
 def smooth_data(data, degree=5):
@@ -12,42 +14,8 @@ def smooth_data(data, degree=5):
     :param degree: Degree of the spline (default: 5)
     :return: Smoothed DataFrame
     """
-    for col in data.columns:
-        x = np.arange(len(data[col]))
-        spl = UnivariateSpline(x, data[col], k=degree)
-        data[col] = spl(x)
-    return data
-
-
-def detect_mutation_points(data_column, threshold=0.5):
-    """
-    Detect mutation points in a data column based on a threshold.
-
-    :param data_column: A pandas Series representing a column of data
-    :param threshold: Threshold for detecting mutations (default: 0.5)
-    :return: List of mutation points
-    """
-    mutation_points = []
-    for i in range(1, len(data_column) - 1):
-        if (abs(data_column.iloc[i] - data_column.iloc[i - 1]) > threshold and
-                abs(data_column.iloc[i + 1] - data_column.iloc[i]) > threshold):
-            mutation_points.append(i)
-    return mutation_points
-
-
-def calculate_mutation_distance(data_column, mutation_range):
-    """
-    Calculate the Euclidean distance between the start and end of the mutation range.
-
-    :param data_column: A pandas Series representing a column of data
-    :param mutation_range: Tuple (start, end) of the mutation range
-    :return: Euclidean distance
-    """
-    start, end = mutation_range
-    x_dist = end - start  # Horizontal distance
-    y_dist = abs(data_column.iloc[end] - data_column.iloc[start])  # Vertical distance
-    distance = sqrt(x_dist**2 + y_dist**2)  # Euclidean distance
-    return distance
+    smoothed = smooth_columns(data.to_numpy(dtype=float), degree, batched=BATCH_SMOOTHING)
+    return pd.DataFrame(smoothed, index=data.index, columns=data.columns)
 
 
 def main():
@@ -62,25 +30,17 @@ def main():
     # Smooth the data using a UnivariateSpline
     data = smooth_data(data, degree=5)
 
-    # Process each column
-    for col in data.columns:
-        # Detect mutation points
-        mutation_points = detect_mutation_points(data[col], threshold)
+    # Detect the overall mutation range of every column at once
+    values = data.to_numpy(dtype=float)
+    starts, ends = detect_mutation_ranges(values, threshold)
 
-        # Determine the overall mutation range
-        overall_mutation_range = None
-        if mutation_points:
-            start = mutation_points[0]
-            end = mutation_points[-1] + 1
-            overall_mutation_range = (start, end)
+    # Calculate the distance between the start and end of each mutation range
+    distances = mutation_distances(values, starts, ends)
 
-        # Output mutation range and distance
-        if overall_mutation_range:
-            start, end = overall_mutation_range
+    # Output mutation range and distance
+    for col, start, end, distance in zip(data.columns, starts, ends, distances):
+        if start >= 0:
             print(f"Column {col}: Overall mutation range from {start} to {end}")
-
-            # Calculate the distance between the start and end of the mutation range
-            distance = calculate_mutation_distance(data[col], overall_mutation_range)
             print(f"Distance between mutation range: {distance}")
 
 
@@ -1,94 +1,55 @@
 import numpy as np
-import cv2
 import os
 import csv
-from math import atan2, degrees
+import sys
 from multiprocessing import Pool, cpu_count
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from slice_stack import open_stack
+from curve_fitting import fit_polynomials, evaluate_polynomials
+from yarn_geometry import extract_midlines, label_columns, base_line_angle, max_segment_deviation, \
+    LABEL_LOW, LABEL_HIGH
+
+# Configuration parameters
+DEGREE = 11  # Degree of the polynomial fitted to each yarn
+SEGMENT_LENGTH = 35  # Midline points per segment when measuring the angle deviation
+CHUNK_SIZE = 16  # Consecutive slices each worker reads and processes per task
+
 
 def extract_contour_skeleton(args):
     """
     Extract contour skeleton points and calculate the maximum angle deviation from the base line.
 
-    :param args: Tuple containing the image path and segment length
-    :return: List of maximum angle deviations for each contour
+    :param args: Tuple containing the slice image (grayscale) and segment length
+    :return: Gray values of the contours and the maximum angle deviation of each
     """
-    img_path, segment_length = args
-    img = cv2.imread(img_path, 0)  # Read the image in grayscale
-    unique_values = np.unique(img)  # Get unique pixel values in the image
-
-    # Filter unique values within the range [80, 130]
-    contour_values = unique_values[(unique_values >= 80) & (unique_values <= 130)]
-
-    # List to store contour points for each value
-    contour_points_list = []
-
-    for value in contour_values:
-        mask = np.zeros_like(img)  # Create a mask for the current value
-        mask[img == value] = 255  # Set pixels with the current value to 255
-
-        contour_points = []  # List to store contour points for the current value
-
-        # Extract contour points by averaging rows for each column
-        for col in range(mask.shape[1]):
-            rows = np.where(mask[:, col] != 0)[0]  # Find non-zero rows in the current column
-            if rows.size > 0:
-                avg_row = (rows[0] + rows[-1]) // 2  # Average the top and bottom rows
-                contour_points.append((col, avg_row))  # Add the point to the contour list
-
-        if len(contour_points) > 0:
-            contour_points_list.append(contour_points)  # Add contour points to the list
-
-    # Calculate the minimum area rectangle for all contour points
-    all_x, all_y = [], []
-    for contour_points in contour_points_list:
-        x, y = zip(*contour_points)
-        all_x.extend(x)
-        all_y.extend(y)
-    rect = cv2.minAreaRect(np.array([(x, y) for x, y in zip(all_x, all_y)], dtype=np.float32))
-    box = cv2.boxPoints(rect)
-    box = np.int0(box)
-
-    # Find the edge with the smallest angle to the horizontal axis as the base line
-    min_angle = 90
-    for i in range(4):
-        p1 = box[i]
-        p2 = box[(i + 1) % 4]
-        dx = p2[0] - p1[0]
-        dy = p2[1] - p1[1]
-        angle = degrees(atan2(dy, dx))
-        if abs(angle) < abs(min_angle):
-            min_angle = angle
+    img, segment_length = args
+    # Midline points (column, row) of every yarn label in [LABEL_LOW, LABEL_HIGH]
+    contour_values, contour_points_list = extract_midlines(img, LABEL_LOW, LABEL_HIGH)
+
+    # The base line is the flattest edge of the minimum area rectangle around all contour points
+    min_angle = base_line_angle(contour_points_list)
 
     # Calculate the maximum angle deviation for each segment of the contour
-    max_angles = []
-    for contour_points in contour_points_list:
-        max_angle = 0
-        for i in range(0, len(contour_points), segment_length):
-            start_x, start_y = contour_points[i]
-            end_x, end_y = contour_points[min(i + segment_length, len(contour_points) - 1)]
-            dx = end_x - start_x
-            dy = end_y - start_y
-            angle = degrees(atan2(dy, dx))
-            angle_diff = abs(angle - min_angle)
-            max_angle = max(max_angle, angle_diff)
-        max_angles.append(max_angle)
-
-    return max_angles
-
-
-def fit_polynomial(x, y, degree):
+    max_angles = [max_segment_deviation(contour_points, segment_length, min_angle)
+                  for contour_points in contour_points_list]
+
+    return contour_values, max_angles
+
+
+def process_chunk(args):
     """
-    Fit a polynomial curve to the given data points.
+    Read and process a range of consecutive slices in a worker process.
+
+    The worker opens the stack itself, so only slice ranges and per-yarn
+    angles cross process boundaries, never decoded images.
 
-    :param x: X-coordinates of the data points
-    :param y: Y-coordinates of the data points
-    :param degree: Degree of the polynomial
-    :return: A polynomial function
+    :param args: Tuple of (image folder, first slice index, slice index to stop before, segment length)
+    :return: List of (gray values, angles) pairs, in slice order
     """
-    coeffs = np.polyfit(x, y, degree)  # Fit the polynomial
-    poly = np.poly1d(coeffs)  # Create a polynomial function
-    return poly
+    image_folder, start, end, segment_length = args
+    image_stack = open_stack(image_folder)
+    return [extract_contour_skeleton((img, segment_length)) for _, img in image_stack.iter_slices(start, end)]
 
 
 def main():
@@ -96,17 +57,15 @@ def main():
     image_folder = 'Yarns/Sample_C_warp'
     output_folder = 'Yarns'
 
-    # Get sorted list of file names in the input folder
-    file_names = sorted(os.listdir(image_folder))
+    # Open the slice stack, from its packed volume if one exists
+    image_stack = open_stack(image_folder)
+    file_names = image_stack.names
 
     # Define the path for the output CSV file
     csv_path = os.path.join(output_folder, f'{os.path.basename(image_folder)}_degree.csv')
 
     # Get all target gray values
-    first_image = file_names[int(len(file_names) / 2)]
-    img = cv2.imread(os.path.join(image_folder, first_image), cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        raise FileNotFoundError(f"Failed to read image file: {first_image}")
+    img = image_stack[int(len(image_stack) / 2)]
 
     gray_values = np.unique(img)[np.unique(img) >= 81]  # Filter gray values >= 81
 
@@ -118,25 +77,23 @@ def main():
         writer.writerow(header)
 
         # Use multiprocessing to process images in parallel
+        chunks = [(image_folder, start, min(start + CHUNK_SIZE, len(file_names)), SEGMENT_LENGTH)
+                  for start in range(0, len(file_names), CHUNK_SIZE)]
         with Pool(processes=cpu_count()) as pool:
-            args = [(os.path.join(image_folder, file_name), 35) for file_name in file_names]
-            angles_list = pool.map(extract_contour_skeleton, args)
-
-        # Fit polynomial curves to each column of the data
-        num_columns = max(len(angles) for angles in angles_list)
-        polyfits = []
-        for col in range(num_columns):
-            x = np.arange(len(file_names))
-            y = [angles_list[i][col] if len(angles_list[i]) > col else 0 for i in range(len(file_names))]
-            poly = fit_polynomial(x, y, 11)  # Adjust the degree of the polynomial here
-            polyfits.append(poly)
-
-        # Write the polynomial coefficients to the CSV file
-        for i, file_name in enumerate(file_names):
-            row = [file_name]
-            for poly in polyfits:
-                row.append(f"{poly(i):.2f}")
-            writer.writerow(row)
+            # One row per slice and one column per gray value; NaN where a yarn is missing
+            results = np.full((len(file_names), len(gray_values)), np.nan)
+            chunk_rows = (row for rows in pool.imap(process_chunk, chunks) for row in rows)
+            for row, (values, angles) in enumerate(chunk_rows):
+                columns, known = label_columns(gray_values, values)
+                results[row, columns[known]] = np.asarray(angles, dtype=float)[known]
+
+        # Fit polynomial curves to all columns at once, skipping slices where a yarn is missing
+        coefficients = fit_polynomials(results, DEGREE)
+        fitted = evaluate_polynomials(coefficients, len(file_names))
+
+        # Write the fitted values to the CSV file
+        for file_name, fitted_row in zip(file_names, fitted):
+            writer.writerow([file_name] + ['' if np.isnan(value) else f"{value:.2f}" for value in fitted_row])
 
 
 if __name__ == '__main__':
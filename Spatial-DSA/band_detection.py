@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+import argparse
+import csv
+import os
+from itertools import product
+
+from curve_fitting import smooth_columns
+
+
+def first_differences(values):
+    """
+    Calculate the absolute jump between consecutive slices of every column.
+
+    :param values: (slices, columns) array of smoothed yarn data
+    :return: (slices - 1, columns) absolute first differences
+    """
+    return np.abs(np.diff(values, axis=0))
+
+
+def mutation_ranges_from_jumps(jumps, thresholds):
+    """
+    Find the overall mutation range of every column for one or several thresholds.
+
+    A slice is a mutation point when the jumps to both its neighbours exceed
+    the threshold. The overall range of a column runs from its first mutation
+    point to one past its last.
+
+    :param jumps: (slices - 1, columns) absolute first differences
+    :param thresholds: Threshold, or array of thresholds that are all evaluated at once
+    :return: Start and end slice of each column's range, -1 for columns without mutations; shaped
+             (columns,) for a single threshold and (thresholds, columns) for an array
+    """
+    thresholds = np.asarray(thresholds, dtype=float)
+    shape = thresholds.shape + jumps.shape[1:]
+    if len(jumps) < 2:
+        return np.full(shape, -1), np.full(shape, -1)
+
+    exceeded = jumps > thresholds[..., None, None]
+    # Row i is slice i + 1, whose jumps from the previous and to the next slice both exceed the threshold
+    mutations = exceeded[..., :-1, :] & exceeded[..., 1:, :]
+    found = mutations.any(axis=-2)
+    starts = np.where(found, mutations.argmax(axis=-2) + 1, -1)
+    ends = np.where(found, mutations.shape[-2] - mutations[..., ::-1, :].argmax(axis=-2) + 1, -1)
+    return starts, ends
+
+
+def detect_mutation_ranges(values, threshold=0.5):
+    """
+    Find the overall mutation range of every column at once.
+
+    :param values: (slices, columns) array of smoothed yarn data
+    :param threshold: Threshold for detecting mutations
+    :return: (columns,) start and end slice of each column's range, -1 for columns without mutations
+    """
+    return mutation_ranges_from_jumps(first_differences(values), threshold)
+
+
+def range_rise(values, starts, ends):
+    """
+    Look up the value change over each column's range.
+
+    :param values: (slices, columns) array
+    :param starts: (columns,) first slice of each range
+    :param ends: (columns,) last slice of each range
+    :return: (columns,) values[end] - values[start]
+    """
+    columns = np.arange(values.shape[1])
+    return values[ends, columns] - values[starts, columns]
+
+
+def mutation_distances(values, starts, ends):
+    """
+    Calculate the Euclidean distance between the start and end of each column's mutation range.
+
+    :param values: (slices, columns) array
+    :param starts: (columns,) range starts from detect_mutation_ranges
+    :param ends: (columns,) range ends from detect_mutation_ranges
+    :return: (columns,) distances, NaN for columns without mutations
+    """
+    distances = np.hypot(ends - starts, range_rise(values, starts, ends))
+    return np.where(starts >= 0, distances, np.nan)
+
+
+def mutation_angles(values, starts, ends):
+    """
+    Calculate the angle of the line from the start to the end of each column's mutation range.
+
+    :param values: (slices, columns) array
+    :param starts: (columns,) range starts from detect_mutation_ranges
+    :param ends: (columns,) range ends from detect_mutation_ranges
+    :return: (columns,) angles in degrees, NaN for columns without mutations
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angles = np.degrees(np.arctan(range_rise(values, starts, ends) / (ends - starts)))
+    return np.where(starts >= 0, angles, np.nan)
+
+
+def line_angles(values):
+    """
+    Calculate the angle of the line from the first to the last slice of each column.
+
+    :param values: (slices, columns) array
+    :return: (columns,) angles in degrees
+    """
+    return np.degrees(np.arctan((values[-1] - values[0]) / (len(values) - 1)))
+
+
+def angle_differences(angles, reference_angles):
+    """
+    Calculate the smallest difference between two sets of line angles.
+
+    :param angles: Angles in degrees
+    :param reference_angles: Angles in degrees
+    :return: Differences in degrees, between 0 and 90
+    """
+    difference = np.abs(angles - reference_angles)
+    return np.minimum(difference, 180 - difference)
+
+
+def sweep_parameters(values, thresholds, degrees=(5,), smoothings=(None,), batched=False):
+    """
+    Detect mutation ranges for every combination of smoothing parameters and thresholds.
+
+    The data is smoothed and differenced once per (degree, smoothing) pair;
+    all thresholds are then evaluated on the same jumps in one operation.
+
+    :param values: (slices, columns) array of raw yarn data
+    :param thresholds: Thresholds for detecting mutations
+    :param degrees: Spline degrees
+    :param smoothings: UnivariateSpline smoothing factors, None for the default
+    :param batched: Smooth with one shared-knot spline fit instead of one spline per column
+    :return: Dictionary of equal-length columns: Degree, Smoothing, Threshold, Yarn, Start, End,
+             Distance, Mutation Angle and Angle Difference; NaN and -1 where a yarn has no mutation
+    """
+    thresholds = np.asarray(thresholds, dtype=float)
+    yarns = np.arange(1, values.shape[1] + 1)
+    table = {name: [] for name in ('Degree', 'Smoothing', 'Threshold', 'Yarn', 'Start', 'End', 'Distance',
+                                   'Mutation Angle', 'Angle Difference')}
+    for degree, smoothing in product(degrees, smoothings):
+        smoothed = smooth_columns(values, degree, smoothing, batched)
+        starts, ends = mutation_ranges_from_jumps(first_differences(smoothed), thresholds)
+        line_angle = line_angles(smoothed)
+        for threshold, threshold_starts, threshold_ends in zip(thresholds, starts, ends):
+            angles = mutation_angles(smoothed, threshold_starts, threshold_ends)
+            table['Degree'].append(np.full(len(yarns), degree))
+            table['Smoothing'].append(np.full(len(yarns), np.nan if smoothing is None else smoothing))
+            table['Threshold'].append(np.full(len(yarns), threshold))
+            table['Yarn'].append(yarns)
+            table['Start'].append(threshold_starts)
+            table['End'].append(threshold_ends)
+            table['Distance'].append(mutation_distances(smoothed, threshold_starts, threshold_ends))
+            table['Mutation Angle'].append(angles)
+            table['Angle Difference'].append(angle_differences(angles, line_angle))
+    return {name: np.concatenate(columns) for name, columns in table.items()}
+
+
+def read_yarn_table(csv_path):
+    """
+    Read a per-slice yarn table such as the output of HSV_Make.py.
+
+    :param csv_path: CSV path
+    :return: Yarn column names and a (slices, yarns) float array; non-numeric columns are dropped
+    """
+    data = pd.read_csv(csv_path).apply(pd.to_numeric, errors='coerce')
+    data = data.loc[:, data.notna().any()]
+    return list(data.columns), data.to_numpy(dtype=float)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep the shear and kink band detection parameters.')
+    parser.add_argument('tables', nargs='+', help='Per-slice yarn CSV files, e.g. Yarns/Sample_F_weft.csv')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.3, 0.5, 0.8, 1.0])
+    parser.add_argument('--degrees', type=int, nargs='+', default=[3, 4, 5])
+    parser.add_argument('--smoothings', type=float, nargs='+', default=None,
+                        help='UnivariateSpline smoothing factors; by default the number of slices')
+    parser.add_argument('--batched', action='store_true', help='Smooth all yarns on shared knots in one fit')
+    parser.add_argument('--output', default='band_sweep.csv', help='Output CSV path')
+    args = parser.parse_args()
+
+    with open(args.output, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        header = None
+        for csv_path in args.tables:
+            columns, values = read_yarn_table(csv_path)
+            table = sweep_parameters(values, args.thresholds, args.degrees, args.smoothings or [None], args.batched)
+            if header is None:
+                header = ['Sample', 'Column'] + list(table)
+                writer.writerow(header)
+
+            sample = os.path.splitext(os.path.basename(csv_path))[0]
+            for row in zip(*table.values()):
+                row = ['' if isinstance(value, float) and np.isnan(value) else value for value in row]
+                writer.writerow([sample, columns[row[3] - 1]] + row)
+
+
+if __name__ == '__main__':
+    main()
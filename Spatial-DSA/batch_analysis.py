@@ -0,0 +1,186 @@
+import numpy as np
+import argparse
+import csv
+import os
+import sys
+from multiprocessing import Pool, cpu_count
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from slice_stack import open_stack, folder_mtime, list_slices, SliceVolume, VOLUME_SUFFIX
+from yarn_metrics import METRICS, analyze_stack, gray_range, write_metric_table
+
+# Configuration parameters
+WORKERS = cpu_count()  # Samples analyzed at the same time, one process each
+
+
+def discover_samples(root):
+    """
+    Find the sample stacks under a folder, as slice folders or packed volumes.
+
+    :param root: Folder holding one slice folder or volume per sample, e.g. Yarns
+    :return: Sorted list of sample folder paths; a volume stands for the folder it was packed from
+    """
+    samples = set()
+    for entry in os.listdir(root):
+        path = os.path.join(root, entry)
+        if entry.endswith(VOLUME_SUFFIX) and os.path.isfile(path):
+            samples.add(path[:-len(VOLUME_SUFFIX)])
+        elif os.path.isdir(path) and list_slices(path):
+            samples.add(path)
+    return sorted(samples)
+
+
+def stack_mtime(image_stack, sample_folder):
+    """
+    Get the time the stack's input data was last modified.
+
+    :param image_stack: Stack returned by open_stack
+    :param sample_folder: Sample folder path
+    :return: Modification time of the volume, or of the newest slice and the folder itself
+    """
+    if isinstance(image_stack, SliceVolume):
+        return os.path.getmtime(image_stack.path)
+    return folder_mtime(sample_folder)
+
+
+def metric_path(output_folder, sample_folder, name):
+    """Path of one metric table of a sample."""
+    sample_name = os.path.basename(os.path.normpath(sample_folder))
+    return os.path.join(output_folder, f'{sample_name}_{name}.csv')
+
+
+def update_sample(sample_folder, output_folder, names, force):
+    """
+    Compute the out-of-date metrics of one sample in a single pass over its volume.
+
+    All analyses of a sample run in the same task, so its slices are read
+    and decoded once however many metrics need updating.
+
+    :param sample_folder: Sample folder path
+    :param output_folder: Folder for the metric tables
+    :param names: Names of the metrics to compute
+    :param force: Recompute metric tables even if they are newer than their input
+    :return: Names of the metrics that were recomputed, and a note if the sample was skipped, else None
+    """
+    image_stack = open_stack(sample_folder)
+    if len(image_stack) == 0:
+        return [], 'skipped, no slices'
+
+    input_time = stack_mtime(image_stack, sample_folder)
+    stale = [name for name in names
+             if force or not os.path.exists(metric_path(output_folder, sample_folder, name))
+             or os.path.getmtime(metric_path(output_folder, sample_folder, name)) < input_time]
+    if not stale:
+        return [], None
+
+    # Get all target gray values from the middle slice
+    low, high = gray_range(sample_folder)
+    gray_values = np.unique(image_stack[len(image_stack) // 2])
+    gray_values = gray_values[(gray_values >= low) & (gray_values <= high)]
+    if len(gray_values) == 0:
+        return [], f'skipped, no yarn gray values in [{low}, {high}]'
+
+    slice_names, results = analyze_stack(sample_folder, gray_values, {name: METRICS[name] for name in stale},
+                                         workers=1)
+    for name, values in results.items():
+        write_metric_table(metric_path(output_folder, sample_folder, name), slice_names, values)
+    return stale, None
+
+
+def analyze_sample(args):
+    """
+    Update one sample's metric tables, reporting errors instead of raising them.
+
+    A broken sample thus costs only its own tables; the rest of the campaign
+    and the summary are still produced.
+
+    :param args: Tuple of (sample folder, output folder, metric names, force flag)
+    :return: Sample folder, the names of the metrics that were recomputed, and a note if the sample
+             was skipped or failed, else None
+    """
+    sample_folder = args[0]
+    try:
+        return (sample_folder,) + update_sample(*args)
+    except Exception as error:
+        return sample_folder, [], f'failed, {type(error).__name__}: {error}'
+
+
+def report_sample(sample_folder, updated, note):
+    """Print the outcome of one sample."""
+    print(f"{os.path.basename(sample_folder)}: {note or ', '.join(updated) or 'up to date'}")
+
+
+def summarize_metric_table(csv_path):
+    """
+    Summarize each yarn column of a metric table.
+
+    :param csv_path: Metric table written by write_metric_table
+    :return: List of (yarn column, valid slices, mean, standard deviation, minimum, maximum) rows
+    """
+    with open(csv_path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        values = np.array([[float(cell) if cell else np.nan for cell in row[1:]] for row in reader]).reshape(
+            -1, len(header) - 1)
+
+    rows = []
+    for column, yarn in enumerate(header[1:]):
+        valid = values[~np.isnan(values[:, column]), column]
+        if len(valid):
+            rows.append((yarn, len(valid), valid.mean(), valid.std(), valid.min(), valid.max()))
+        else:
+            rows.append((yarn, 0, np.nan, np.nan, np.nan, np.nan))
+    return rows
+
+
+def run_batch(root, output_folder=None, names=tuple(METRICS), workers=WORKERS, force=False):
+    """
+    Analyze every sample under a folder and write a combined summary table.
+
+    :param root: Folder holding the sample stacks
+    :param output_folder: Folder for the metric tables and the summary, the root by default
+    :param names: Names of the metrics to compute
+    :param workers: Number of samples analyzed at the same time
+    :param force: Recompute metric tables even if they are newer than their input
+    :return: Path of the summary table
+    """
+    output_folder = output_folder or root
+    samples = discover_samples(root)
+    tasks = [(sample_folder, output_folder, list(names), force) for sample_folder in samples]
+
+    if workers <= 1:
+        for result in map(analyze_sample, tasks):
+            report_sample(*result)
+    else:
+        with Pool(processes=min(workers, max(1, len(tasks)))) as pool:
+            for result in pool.imap_unordered(analyze_sample, tasks):
+                report_sample(*result)
+
+    summary_path = os.path.join(output_folder, 'batch_summary.csv')
+    with open(summary_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Sample', 'Metric', 'Yarn', 'Slices', 'Mean', 'Std', 'Min', 'Max'])
+        for sample_folder in samples:
+            for name in names:
+                path = metric_path(output_folder, sample_folder, name)
+                if not os.path.exists(path):
+                    continue
+                for yarn, count, *statistics in summarize_metric_table(path):
+                    writer.writerow([os.path.basename(sample_folder), name, yarn, count] +
+                                    ['' if np.isnan(value) else f'{value:.4f}' for value in statistics])
+    return summary_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the Spatial-DSA analyses on every sample of a test campaign.')
+    parser.add_argument('root', nargs='?', default='Yarns', help='Folder holding one slice folder or volume per sample')
+    parser.add_argument('--output', help='Output folder, by default the root folder')
+    parser.add_argument('--metrics', nargs='+', choices=list(METRICS), default=list(METRICS))
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--force', action='store_true', help='Recompute tables that are up to date')
+    args = parser.parse_args()
+    print(run_batch(args.root, args.output, args.metrics, args.workers, args.force))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import numpy as np
+from scipy.interpolate import UnivariateSpline, make_lsq_spline
+
+# Configuration parameters
+SPLINE_KNOT_SPACING = 50  # Samples between the interior knots of the batched smoothing spline
+
+
+def missing_patterns(values):
+    """
+    Group the columns of a table by which samples they are missing.
+
+    Columns with the same pattern share one design matrix, so each group is
+    solved with a single least-squares call however many columns it holds.
+
+    :param values: (samples, columns) array with NaN for missing samples
+    :return: List of (valid sample mask, column indices) pairs; columns without any sample are left out
+    """
+    valid = ~np.isnan(values)
+    groups = {}
+    for column, key in enumerate(np.packbits(valid, axis=0).T):
+        groups.setdefault(key.tobytes(), []).append(column)
+    return [(valid[:, columns[0]], np.array(columns)) for columns in groups.values() if valid[:, columns[0]].any()]
+
+
+def chebyshev_design(sample_count, degree):
+    """
+    Build the Chebyshev design matrix for samples 0 .. sample_count - 1.
+
+    The sample positions are mapped onto [-1, 1], where Chebyshev polynomials
+    stay well conditioned even at the degrees used for the yarn curves; the
+    plain power basis of np.polyfit at x up to 1,000 is not.
+
+    :param sample_count: Number of samples
+    :param degree: Polynomial degree
+    :return: (sample_count, degree + 1) design matrix
+    """
+    x = np.linspace(-1, 1, sample_count) if sample_count > 1 else np.zeros(sample_count)
+    return np.polynomial.chebyshev.chebvander(x, degree)
+
+
+def fit_polynomials(values, degree):
+    """
+    Fit a polynomial to every column of a table at once.
+
+    All columns share one Chebyshev design matrix; each group of columns with
+    the same missing samples is solved with one QR factorization and one
+    matrix product.
+
+    :param values: (samples, columns) array with NaN for missing samples
+    :param degree: Polynomial degree
+    :return: (degree + 1, columns) Chebyshev coefficients, NaN for columns without samples
+    """
+    design = chebyshev_design(len(values), degree)
+    coefficients = np.full((degree + 1, values.shape[1]), np.nan)
+    for valid, columns in missing_patterns(values):
+        rows = design[valid]
+        targets = values[np.ix_(valid, columns)]
+        if len(rows) > degree:
+            q, r = np.linalg.qr(rows)
+            coefficients[:, columns] = np.linalg.solve(r, q.T @ targets)
+        else:
+            # Fewer samples than coefficients: take the minimum-norm solution
+            coefficients[:, columns] = np.linalg.lstsq(rows, targets, rcond=None)[0]
+    return coefficients
+
+
+def evaluate_polynomials(coefficients, sample_count):
+    """
+    Evaluate fitted polynomials at every sample with one matrix product.
+
+    :param coefficients: (degree + 1, columns) coefficients from fit_polynomials
+    :param sample_count: Number of samples the polynomials were fitted on
+    :return: (samples, columns) fitted values
+    """
+    return chebyshev_design(sample_count, len(coefficients) - 1) @ coefficients
+
+
+def smooth_splines(values, degree=5, knot_spacing=SPLINE_KNOT_SPACING):
+    """
+    Smooth every column of a table with a least-squares spline on shared, evenly spaced knots.
+
+    Unlike one UnivariateSpline per column, which picks its own knots, all
+    columns with the same missing samples are fitted in one B-spline
+    least-squares solve.
+
+    :param values: (samples, columns) array with NaN for missing samples
+    :param degree: Spline degree
+    :param knot_spacing: Samples between interior knots
+    :return: (samples, columns) smoothed values, NaN for columns without enough samples
+    """
+    x = np.arange(len(values), dtype=float)
+    smoothed = np.full(values.shape, np.nan)
+    for valid, columns in missing_patterns(values):
+        x_valid = x[valid]
+        if len(x_valid) <= degree:
+            continue
+        interior = np.arange(x_valid[0] + knot_spacing, x_valid[-1] - knot_spacing / 2, knot_spacing)
+        knots = np.concatenate([[x_valid[0]] * (degree + 1), interior, [x_valid[-1]] * (degree + 1)])
+        spline = make_lsq_spline(x_valid, values[np.ix_(valid, columns)], knots, k=degree)
+        smoothed[:, columns] = spline(x)
+    return smoothed
+
+
+def smooth_columns(values, degree=5, smoothing=None, batched=False):
+    """
+    Smooth every column of a table with a spline.
+
+    :param values: (samples, columns) array with NaN for missing samples
+    :param degree: Spline degree
+    :param smoothing: UnivariateSpline smoothing factor s, None for its default (the number of samples)
+    :param batched: Fit all columns with smooth_splines on shared knots instead of one adaptive
+                    UnivariateSpline per column; smoothing is then ignored
+    :return: (samples, columns) smoothed values, NaN for columns without enough samples
+    """
+    if batched:
+        return smooth_splines(values, degree)
+
+    x = np.arange(len(values))
+    smoothed = np.full(values.shape, np.nan)
+    for column in range(values.shape[1]):
+        valid = ~np.isnan(values[:, column])
+        if valid.sum() > degree:
+            smoothed[:, column] = UnivariateSpline(x[valid], values[valid, column], k=degree, s=smoothing)(x)
+    return smoothed
@@ -0,0 +1,155 @@
+import cv2
+import numpy as np
+
+# Configuration parameters
+LABEL_LOW = 80  # Lowest gray value of a yarn label
+LABEL_HIGH = 130  # Highest gray value of a yarn label
+
+
+def extract_midlines(img, low=LABEL_LOW, high=LABEL_HIGH):
+    """
+    Extract the midline of every yarn label in a slice at once.
+
+    For each label and image column, the midline point is halfway between the
+    first and last row the label occupies. Only the first and last pixel of a
+    vertical run can be such an extreme, so those run ends are gathered for all
+    labels together and reduced per (label, column) instead of scanning every
+    column of every label.
+
+    :param img: Label slice (grayscale), yarns drawn with gray values in [low, high]
+    :param low: Lowest gray value of a yarn label
+    :param high: Highest gray value of a yarn label
+    :return: Gray values present, in ascending order, and for each a (N, 2) array of (column, row)
+             midline points in column order
+    """
+    counts = np.bincount(img.ravel(), minlength=256)
+    values = np.flatnonzero(counts[low:high + 1]) + low
+    if len(values) == 0:
+        return values, []
+
+    # Map the labels to 1..n and everything else to 0
+    lookup = np.zeros(256, dtype=np.uint8)
+    lookup[values] = np.arange(1, len(values) + 1)
+    labels = cv2.LUT(img, lookup)
+
+    height, width = img.shape
+    same_as_next = labels[1:] == labels[:-1]
+    first_rows = np.full((len(values) + 1, width), height)
+    last_rows = np.full((len(values) + 1, width), -1)
+
+    run_starts = labels.copy()
+    run_starts[1:][same_as_next] = 0
+    rows, cols = np.nonzero(run_starts)
+    np.minimum.at(first_rows, (run_starts[rows, cols], cols), rows)
+
+    run_ends = labels.copy()
+    run_ends[:-1][same_as_next] = 0
+    rows, cols = np.nonzero(run_ends)
+    np.maximum.at(last_rows, (run_ends[rows, cols], cols), rows)
+
+    present = last_rows[1:] >= 0
+    middle_rows = (first_rows[1:] + last_rows[1:]) // 2
+    midlines = []
+    for label_index in range(len(values)):
+        cols = np.flatnonzero(present[label_index])
+        midlines.append(np.column_stack([cols, middle_rows[label_index, cols]]))
+    return values, midlines
+
+
+def label_statistics(img, gray_values):
+    """
+    Calculate pixel counts, centroids and bounding boxes of several labels in one pass per axis.
+
+    One np.bincount over (gray value, row) pairs gives every label's row
+    histogram, and one over (gray value, column) pairs its column histogram.
+    Counts, centroids and extents all follow from these, so the slice is not
+    rescanned per label.
+
+    :param img: Label slice (grayscale)
+    :param gray_values: Gray values of the labels
+    :return: (N,) pixel counts, (N, 2) float (x, y) centroids, NaN for absent labels, and (N, 4)
+             (x, y, width, height) bounding boxes, zero for absent labels
+    """
+    gray_values = np.asarray(gray_values, dtype=np.intp)
+    height, width = img.shape
+    values = img.astype(np.intp)
+    row_histograms = np.bincount((values * height + np.arange(height)[:, None]).ravel(),
+                                 minlength=256 * height).reshape(256, height)[gray_values]
+    col_histograms = np.bincount((values * width + np.arange(width)).ravel(),
+                                 minlength=256 * width).reshape(256, width)[gray_values]
+
+    counts = row_histograms.sum(axis=1)
+    present = counts > 0
+    centroids = np.full((len(gray_values), 2), np.nan)
+    centroids[present, 0] = col_histograms[present] @ np.arange(width) / counts[present]
+    centroids[present, 1] = row_histograms[present] @ np.arange(height) / counts[present]
+
+    boxes = np.zeros((len(gray_values), 4), dtype=np.intp)
+    for axis, histograms in ((0, col_histograms), (1, row_histograms)):
+        occupied = histograms[present] > 0
+        first = occupied.argmax(axis=1)
+        last = occupied.shape[1] - 1 - occupied[:, ::-1].argmax(axis=1)
+        boxes[present, axis] = first
+        boxes[present, axis + 2] = last - first + 1
+    return counts, centroids, boxes
+
+
+def min_rect_height(midline):
+    """
+    Calculate the vertical extent of the minimum area rectangle around a midline.
+
+    :param midline: (N, 2) array of (column, row) midline points
+    :return: Height of the rectangle's corner points, 0 for a single point
+    """
+    if len(midline) <= 1:  # A single point is treated as a flat skeleton
+        return 0
+    box = cv2.boxPoints(cv2.minAreaRect(midline.astype(np.float32))).astype(np.intp)
+    return int(box[:, 1].max() - box[:, 1].min())
+
+
+def base_line_angle(midlines):
+    """
+    Find the angle of the base line of a slice's yarns.
+
+    The base line is the edge of the minimum area rectangle around all
+    midline points with the smallest angle to the horizontal axis.
+
+    :param midlines: List of (N, 2) arrays of (column, row) midline points
+    :return: Angle in degrees
+    """
+    box = cv2.boxPoints(cv2.minAreaRect(np.concatenate(midlines).astype(np.float32))).astype(np.intp)
+    edges = np.roll(box, -1, axis=0) - box
+    angles = np.degrees(np.arctan2(edges[:, 1], edges[:, 0]))
+    # First edge with the smallest absolute angle, starting from 90 degrees
+    return float(angles[np.argmin(np.abs(angles))]) if np.abs(angles).min() < 90 else 90.0
+
+
+def max_segment_deviation(midline, segment_length, base_angle):
+    """
+    Calculate the largest angle between a midline segment and the base line.
+
+    :param midline: (N, 2) array of (column, row) midline points
+    :param segment_length: Number of midline points per segment
+    :param base_angle: Base line angle in degrees
+    :return: Maximum absolute angle deviation in degrees, 0 if no segment deviates
+    """
+    starts = np.arange(0, len(midline), segment_length)
+    ends = np.minimum(starts + segment_length, len(midline) - 1)
+    delta = midline[ends] - midline[starts]
+    angles = np.degrees(np.arctan2(delta[:, 1], delta[:, 0]))
+    return max(0.0, float(np.abs(angles - base_angle).max()))
+
+
+def label_columns(gray_values, values):
+    """
+    Find the result column of each label in a table with one column per gray value.
+
+    :param gray_values: Sorted gray values of the table columns
+    :param values: Gray values of the labels found in a slice
+    :return: Column index of each label and a boolean mask of the labels that have a column
+    """
+    gray_values = np.asarray(gray_values)
+    columns = np.searchsorted(gray_values, values)
+    known = columns < len(gray_values)
+    known[known] = gray_values[columns[known]] == np.asarray(values)[known]
+    return columns, known
@@ -0,0 +1,239 @@
+import numpy as np
+import argparse
+import csv
+import os
+import sys
+from multiprocessing import Pool, cpu_count
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from slice_stack import open_stack
+from yarn_geometry import extract_midlines, label_statistics, min_rect_height, base_line_angle, \
+    max_segment_deviation, LABEL_LOW, LABEL_HIGH
+
+# Configuration parameters
+WORKERS = cpu_count()  # Worker processes; 1 analyzes the slices in this process
+CHUNK_SIZE = 16  # Consecutive slices each worker reads and analyzes per task
+SEGMENT_LENGTH = 35  # Midline points per segment for the crimp angle
+GRAY_RANGES = {'warp': (81, 130), 'weft': (181, 254)}  # Yarn gray values by the sample name's suffix
+
+
+class SliceGeometry:
+    """
+    Per-yarn geometry of one label slice, shared by all metric calculators.
+
+    Each kind of geometry is extracted on first use and then cached, so any
+    number of metrics costs one midline extraction and one statistics pass.
+    """
+
+    def __init__(self, img, gray_values, label_range=None):
+        """
+        :param img: Label slice (grayscale)
+        :param gray_values: Gray values of the yarns, one result column each
+        :param label_range: (lowest, highest) gray value of the labels the crimp base line is fitted to;
+                            by default [LABEL_LOW, LABEL_HIGH] as in the scripts when it holds all gray
+                            values, else their span
+        """
+        self.img = img
+        self.gray_values = np.asarray(gray_values)
+        if label_range is None:
+            label_range = (LABEL_LOW, LABEL_HIGH)
+            if len(self.gray_values) and (self.gray_values.min() < LABEL_LOW or self.gray_values.max() > LABEL_HIGH):
+                label_range = (int(self.gray_values.min()), int(self.gray_values.max()))
+        self.label_range = label_range
+        self._midlines = None
+        self._all_midlines = None
+        self._statistics = None
+        self._rect_heights = None
+
+    def _extract_midlines(self):
+        if len(self.gray_values) == 0:
+            self._midlines, self._all_midlines = [], []
+            return
+        values, midlines = extract_midlines(self.img, *self.label_range)
+        lookup = dict(zip(values.tolist(), midlines))
+        self._midlines = [lookup.get(value) for value in self.gray_values.tolist()]
+        self._all_midlines = midlines
+
+    @property
+    def midlines(self):
+        """(N, 2) arrays of (column, row) midline points per gray value, None for absent yarns"""
+        if self._midlines is None:
+            self._extract_midlines()
+        return self._midlines
+
+    @property
+    def all_midlines(self):
+        """Midlines of every label within the label range, including ones without a column"""
+        if self._all_midlines is None:
+            self._extract_midlines()
+        return self._all_midlines
+
+    @property
+    def statistics(self):
+        """Pixel counts, (x, y) centroids and (x, y, width, height) boxes per gray value"""
+        if self._statistics is None:
+            self._statistics = label_statistics(self.img, self.gray_values)
+        return self._statistics
+
+    @property
+    def rect_heights(self):
+        """Minimum area rectangle height of each midline, NaN for absent yarns"""
+        if self._rect_heights is None:
+            self._rect_heights = np.array([np.nan if midline is None else min_rect_height(midline)
+                                           for midline in self.midlines])
+        return self._rect_heights
+
+
+def centroid_y(geometry):
+    """
+    Centroid height of each yarn, the indicator of HSV_Make.py.
+
+    :param geometry: SliceGeometry
+    :return: Y-axis centroid per gray value, NaN for absent yarns
+    """
+    return geometry.statistics[1][:, 1]
+
+
+def shear_height(geometry):
+    """
+    Minimum area rectangle height of each yarn midline, the indicator of H_longitudinal_shearing.py.
+
+    :param geometry: SliceGeometry
+    :return: Height per gray value, NaN for absent yarns
+    """
+    return geometry.rect_heights
+
+
+def crimp_angle(geometry):
+    """
+    Largest segment angle of each yarn midline against the base line, the indicator of Z_longitudinal_crimping.py.
+
+    :param geometry: SliceGeometry
+    :return: Angle deviation in degrees per gray value, NaN for absent yarns
+    """
+    if not geometry.all_midlines:
+        return np.full(len(geometry.gray_values), np.nan)
+    base_angle = base_line_angle(geometry.all_midlines)
+    return np.array([np.nan if midline is None else max_segment_deviation(midline, SEGMENT_LENGTH, base_angle)
+                     for midline in geometry.midlines])
+
+
+# Metric calculators by name; each maps a SliceGeometry to one value per gray value
+METRICS = {
+    'centroid_y': centroid_y,
+    'shear_height': shear_height,
+    'crimp_angle': crimp_angle,
+}
+
+
+def analyze_chunk(args):
+    """
+    Read a range of consecutive slices once and compute every metric on each.
+
+    :param args: Tuple of (image folder, first slice index, slice index to stop before, gray values,
+                 name -> metric calculator, label range or None)
+    :return: Slice names and a (slices, metrics, gray values) array in the order of the calculators
+    """
+    image_folder, start, end, gray_values, metrics, label_range = args
+    image_stack = open_stack(image_folder)
+    names = []
+    results = np.full((end - start, len(metrics), len(gray_values)), np.nan)
+    for row, (image_path, img) in enumerate(image_stack.iter_slices(start, end)):
+        geometry = SliceGeometry(img, gray_values, label_range)
+        names.append(os.path.basename(image_path))
+        for column, metric in enumerate(metrics.values()):
+            results[row, column] = metric(geometry)
+    return names, results
+
+
+def analyze_stack(image_folder, gray_values, metrics=METRICS, workers=WORKERS, chunk_size=CHUNK_SIZE,
+                  label_range=None):
+    """
+    Compute all metrics for every slice of a stack in one pass over the volume.
+
+    :param image_folder: Slice folder, or the folder of a packed volume
+    :param gray_values: Gray values of the yarns
+    :param metrics: Name -> metric calculator; calculators must be module-level functions to run in workers
+    :param workers: Number of worker processes
+    :param chunk_size: Number of consecutive slices per task
+    :param label_range: Gray value range of the crimp base line labels, see SliceGeometry
+    :return: Slice names and name -> (slices, gray values) array of each metric, NaN for absent yarns
+    """
+    stack_length = len(open_stack(image_folder))
+    chunks = [(image_folder, start, min(start + chunk_size, stack_length), gray_values, metrics, label_range)
+              for start in range(0, stack_length, chunk_size)]
+    if workers <= 1:
+        results = [analyze_chunk(chunk) for chunk in chunks]
+    else:
+        with Pool(processes=workers) as pool:
+            results = pool.map(analyze_chunk, chunks)
+
+    names = [name for chunk_names, _ in results for name in chunk_names]
+    values = np.concatenate([chunk_values for _, chunk_values in results]) if results else \
+        np.zeros((0, len(metrics), len(gray_values)))
+    return names, {name: values[:, column] for column, name in enumerate(metrics)}
+
+
+def gray_range(sample_folder):
+    """
+    Look up the yarn gray value range of a sample from its name, e.g. Sample_F_weft.
+
+    :param sample_folder: Sample folder path
+    :return: (lowest, highest) yarn gray value; warp yarns if the name has no known suffix
+    """
+    suffix = os.path.basename(os.path.normpath(sample_folder)).rsplit('_', 1)[-1].lower()
+    return GRAY_RANGES.get(suffix, GRAY_RANGES['warp'])
+
+
+def write_metric_table(csv_path, names, values):
+    """
+    Write one metric as a CSV table with one row per slice and one column per yarn.
+
+    :param csv_path: Output CSV path
+    :param names: Slice names
+    :param values: (slices, gray values) array; NaN is written as an empty cell
+    """
+    with open(csv_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['File Name'] + [f'Yarn {i + 1}' for i in range(values.shape[1])])
+        for name, row in zip(names, values):
+            writer.writerow([name] + ['' if np.isnan(value) else f'{value:.2f}' for value in row])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute all Spatial-DSA damage indicators in one pass.')
+    parser.add_argument('folder', help='Label slice folder, e.g. Yarns/Sample_A_warp')
+    parser.add_argument('--low', type=int,
+                        help='Lowest yarn gray value, by default 81 for *_warp and 181 for *_weft folders')
+    parser.add_argument('--high', type=int,
+                        help='Highest yarn gray value, by default 130 for *_warp and 254 for *_weft folders')
+    parser.add_argument('--metrics', nargs='+', choices=list(METRICS), default=list(METRICS))
+    parser.add_argument('--output', help='Output folder, by default the parent of the slice folder')
+    args = parser.parse_args()
+
+    # Gray values not given follow the yarn type in the folder name, as in batch_analysis
+    low, high = gray_range(args.folder)
+    low = low if args.low is None else args.low
+    high = high if args.high is None else args.high
+    if low > high:
+        parser.error(f'--low {low} is above --high {high}')
+
+    image_stack = open_stack(args.folder)
+    if len(image_stack) == 0:
+        raise FileNotFoundError(f"No image files found in: {args.folder}")
+
+    # Get all target gray values from the middle slice
+    img = image_stack[len(image_stack) // 2]
+    gray_values = np.unique(img)
+    gray_values = gray_values[(gray_values >= low) & (gray_values <= high)]
+
+    names, results = analyze_stack(args.folder, gray_values, {name: METRICS[name] for name in args.metrics})
+
+    sample_name = os.path.basename(os.path.normpath(args.folder))
+    output_folder = args.output or os.path.dirname(os.path.normpath(args.folder))
+    for name, values in results.items():
+        write_metric_table(os.path.join(output_folder, f'{sample_name}_{name}.csv'), names, values)
+
+
+if __name__ == '__main__':
+    main()
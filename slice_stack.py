@@ -0,0 +1,572 @@
+import cv2
+import numpy as np
+import argparse
+import json
+import os
+import re
+import struct
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Configuration parameters
+SLICE_EXTENSIONS = ('.png', '.jpg')
+PREFETCH_DEPTH = 16  # Maximum number of slices decoded ahead of the consumer
+DECODE_WORKERS = 4
+WRITE_WORKERS = 4
+PNG_COMPRESSION = 1  # cv2.IMWRITE_PNG_COMPRESSION level, 0 (fastest) to 9 (smallest)
+VOLUME_SUFFIX = '.vol'
+VOLUME_MAGIC = b'XCTVOL01'
+VOLUME_DATA_OFFSET = 64  # Voxel data starts here; the JSON header is stored after the voxels
+TRACK_MAGIC = b'YRNTRK01'
+
+# One record per yarn per tracked slice; a record file is a flat array of these
+TRACK_RECORD_DTYPE = np.dtype([
+    ('slice', '<i4'),  # Slice index in the stack
+    ('yarn', '<i2'),  # Yarn ID; the yarn is drawn as yarn + gray_value
+    ('center_x', '<i4'),
+    ('center_y', '<i4'),
+    ('area', '<i4'),  # Pixel count of the yarn mask
+    ('box_x', '<i4'),
+    ('box_y', '<i4'),
+    ('box_width', '<i4'),
+    ('box_height', '<i4'),
+    ('iou', '<f4'),  # IoU of the accepted match, NaN when the mask was carried forward
+    ('tier', 'i1'),  # Staleness tier after the slice
+    ('carried', '?'),  # True if the previous mask was carried forward
+])
+
+
+def slice_index(file_name):
+    """
+    Extract the slice index from a file name such as QIU5_0300.png.
+
+    :param file_name: Slice file name or path
+    :return: Last number in the file name, or -1 if it has none
+    """
+    numbers = re.findall(r'\d+', os.path.splitext(os.path.basename(file_name))[0])
+    return int(numbers[-1]) if numbers else -1
+
+
+def list_slices(folder, extensions=SLICE_EXTENSIONS):
+    """
+    List the slice images of a stack, sorted by slice index.
+
+    :param folder: Folder holding one image per slice
+    :param extensions: Accepted file extensions
+    :return: Sorted list of slice paths
+    """
+    file_names = [f for f in os.listdir(folder) if f.lower().endswith(extensions)]
+    file_names.sort(key=lambda f: (slice_index(f), f))
+    return [os.path.join(folder, f) for f in file_names]
+
+
+def read_slice(path, flags=cv2.IMREAD_GRAYSCALE):
+    """
+    Decode a single slice image.
+
+    :param path: Path to the image file
+    :param flags: cv2.imread flags
+    :return: Decoded image
+    """
+    img = cv2.imread(path, flags)
+    if img is None:
+        raise FileNotFoundError(f"Failed to read image file: {path}")
+    return img
+
+
+def read_slices(paths, flags=cv2.IMREAD_GRAYSCALE, workers=DECODE_WORKERS, prefetch=PREFETCH_DEPTH,
+                skip_errors=False):
+    """
+    Decode slices in a background thread pool and yield them in order.
+
+    At most `prefetch` slices are decoded ahead of the consumer, so decoding
+    overlaps with processing while memory stays bounded.
+
+    :param paths: Slice paths in the order they should be yielded
+    :param flags: cv2.imread flags
+    :param workers: Number of decoding threads
+    :param prefetch: Maximum number of slices decoded ahead
+    :param skip_errors: Print and skip slices that cannot be read instead of raising
+    :return: Generator of (path, image) pairs
+    """
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        def submit_next():
+            path = next(paths, None)
+            if path is not None:
+                pending.append((path, executor.submit(read_slice, path, flags)))
+
+        for _ in range(max(1, prefetch)):
+            submit_next()
+
+        try:
+            while pending:
+                path, future = pending.popleft()
+                submit_next()
+                try:
+                    img = future.result()
+                except (FileNotFoundError, cv2.error) as error:
+                    if not skip_errors:
+                        raise
+                    print(f"Error reading slice: {path} - {error}")
+                    continue
+                yield path, img
+        finally:
+            # Drop queued decodes if the consumer stops early
+            for _, future in pending:
+                future.cancel()
+
+
+class SliceFolder:
+    """
+    Slice stack stored as one image file per slice.
+    """
+
+    def __init__(self, folder):
+        """
+        List the slices of the folder.
+
+        :param folder: Folder holding one image per slice
+        """
+        self.paths = list_slices(folder)
+        self.names = [os.path.basename(path) for path in self.paths]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return read_slice(self.paths[index])
+
+    def iter_slices(self, start=0, end=None, skip_errors=False):
+        """
+        Yield the slices of a range in order, decoded ahead in the background.
+
+        :param start: First slice index
+        :param end: Slice index to stop before, or None for the end of the stack
+        :param skip_errors: Print and skip unreadable slices instead of raising
+        :return: Generator of (name, image) pairs
+        """
+        for path, img in read_slices(self.paths[start:end], skip_errors=skip_errors):
+            yield os.path.basename(path), img
+
+
+class SliceVolume:
+    """
+    Slice stack packed into a single memory-mapped uint8 volume file.
+
+    The file holds VOLUME_MAGIC, the (slices, height, width) voxels from
+    VOLUME_DATA_OFFSET, a JSON header with the shape, slice names and
+    gray-level legend, and finally the header length as a uint64.
+    """
+
+    def __init__(self, path):
+        """
+        Read the header and map the voxels read-only.
+
+        :param path: Path to a volume file written by pack_volume
+        """
+        with open(path, 'rb') as file:
+            if file.read(len(VOLUME_MAGIC)) != VOLUME_MAGIC:
+                raise ValueError(f"Not a slice volume file: {path}")
+            file.seek(-8, os.SEEK_END)
+            header_length, = struct.unpack('<Q', file.read(8))
+            file.seek(-8 - header_length, os.SEEK_END)
+            header = json.loads(file.read(header_length).decode('utf-8'))
+
+        self.path = path
+        self.shape = tuple(header['shape'])
+        self.names = header['names']
+        self.gray_levels = {int(value): count for value, count in header['gray_levels'].items()}
+        self.data = np.memmap(path, dtype=np.uint8, mode='r', offset=VOLUME_DATA_OFFSET, shape=self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def iter_slices(self, start=0, end=None, skip_errors=False):
+        """
+        Yield the slices of a range in order as views into the volume.
+
+        :param start: First slice index
+        :param end: Slice index to stop before, or None for the end of the stack
+        :param skip_errors: Accepted for compatibility with SliceFolder; packed slices are always readable
+        :return: Generator of (name, image) pairs
+        """
+        for index in range(start, len(self) if end is None else end):
+            yield self.names[index], self.data[index]
+
+    def reslice(self, axis):
+        """
+        View the volume with another axis as the slice axis, without copying.
+
+        :param axis: 0 for the original slices, 1 for rows, 2 for columns
+        :return: Volume view with the chosen axis first
+        """
+        return np.moveaxis(self.data, axis, 0)
+
+
+def volume_path(folder):
+    """
+    Get the path of the packed volume belonging to a slice folder.
+
+    :param folder: Slice folder
+    :return: Volume file path next to the folder
+    """
+    return os.path.normpath(folder) + VOLUME_SUFFIX
+
+
+def pack_volume(folder, path=None):
+    """
+    Pack a slice folder into a single memory-mapped volume file.
+
+    The gray-level legend maps every gray value present in the stack to its
+    voxel count, so yarn labels can be listed without scanning the volume.
+
+    :param folder: Folder holding one image per slice
+    :param path: Output path, next to the folder by default
+    :return: Path of the written volume
+    """
+    stack = SliceFolder(folder)
+    if len(stack) == 0:
+        raise FileNotFoundError(f"No image files found in: {folder}")
+    path = path or volume_path(folder)
+    height, width = stack[0].shape[:2]
+    shape = (len(stack), height, width)
+
+    # Write next to the target and rename, so a crash never leaves a truncated volume in place
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(VOLUME_MAGIC.ljust(VOLUME_DATA_OFFSET, b'\0'))
+        file.truncate(VOLUME_DATA_OFFSET + len(stack) * height * width)
+
+    data = np.memmap(temp_path, dtype=np.uint8, mode='r+', offset=VOLUME_DATA_OFFSET, shape=shape)
+    histogram = np.zeros(256, dtype=np.int64)
+    for index, (name, img) in enumerate(stack.iter_slices()):
+        if img.shape != (height, width):
+            raise ValueError(f"Slice {name} has shape {img.shape}, expected {(height, width)}")
+        data[index] = img
+        histogram += np.bincount(img.ravel(), minlength=256)
+    data.flush()
+    del data
+
+    header = json.dumps({
+        'shape': shape,
+        'names': stack.names,
+        'gray_levels': {int(value): int(histogram[value]) for value in np.flatnonzero(histogram)},
+    }).encode('utf-8')
+    with open(temp_path, 'ab') as file:
+        file.write(header)
+        file.write(struct.pack('<Q', len(header)))
+    os.replace(temp_path, path)
+    return path
+
+
+def folder_mtime(folder, extensions=SLICE_EXTENSIONS):
+    """
+    Get the time a slice folder's contents were last modified.
+
+    Overwriting a slice in place does not touch the folder's own mtime, so
+    the slice files are checked as well.
+
+    :param folder: Slice folder
+    :param extensions: Accepted file extensions
+    :return: Newest modification time of the folder and its slice files
+    """
+    mtimes = [os.path.getmtime(folder)]
+    with os.scandir(folder) as entries:
+        mtimes.extend(entry.stat().st_mtime for entry in entries
+                      if entry.name.lower().endswith(extensions) and entry.is_file())
+    return max(mtimes)
+
+
+def open_stack(folder):
+    """
+    Open a slice stack, preferring its packed volume when it is up to date.
+
+    :param folder: Slice folder; its volume is looked up next to it
+    :return: SliceVolume if a volume at least as new as the folder and every slice in it exists, else SliceFolder
+    """
+    path = volume_path(folder)
+    if os.path.exists(path) and (not os.path.isdir(folder) or os.path.getmtime(path) >= folder_mtime(folder)):
+        return SliceVolume(path)
+    return SliceFolder(folder)
+
+
+def write_slice(path, img, compression=PNG_COMPRESSION):
+    """
+    Encode a single slice image.
+
+    :param path: Output path; the extension selects the format
+    :param img: Image to write
+    :param compression: PNG compression level
+    """
+    if not cv2.imwrite(path, img, [cv2.IMWRITE_PNG_COMPRESSION, compression]):
+        raise IOError(f"Failed to write image file: {path}")
+
+
+class SliceWriter:
+    """
+    Write finished slices as image files from a background thread pool.
+
+    At most `max_pending` slices wait to be encoded, so a slow disk throttles
+    the producer instead of filling memory. Write errors are raised on the
+    next call or on close.
+    """
+
+    def __init__(self, output_directory, compression=PNG_COMPRESSION, workers=WRITE_WORKERS,
+                 max_pending=PREFETCH_DEPTH):
+        """
+        Start the writer pool.
+
+        :param output_directory: Directory the slices are written to
+        :param compression: PNG compression level
+        :param workers: Number of encoding threads
+        :param max_pending: Maximum number of slices queued for writing
+        """
+        self.output_directory = output_directory
+        self.compression = compression
+        self.max_pending = max(1, max_pending)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+
+    def write(self, name, img):
+        """
+        Queue a slice for writing. The image must not be modified afterwards.
+
+        :param name: Slice file name
+        :param img: Image to write
+        """
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        path = os.path.join(self.output_directory, name)
+        self.pending.append(self.executor.submit(write_slice, path, img, self.compression))
+
+    def flush(self):
+        """
+        Wait for all queued slices to be written, e.g. before a checkpoint.
+        """
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        """
+        Wait for all queued slices to be written.
+        """
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LabelVolumeWriter:
+    """
+    Stream slices into one compressed label volume instead of one file per slice.
+
+    The result is a regular .npz archive holding one deflated array per slice
+    (slice_00000, slice_00001, ...) and the slice names under 'names', so
+    np.load reads single slices without decompressing the whole volume.
+    Compression runs on a background thread.
+    """
+
+    def __init__(self, path, max_pending=PREFETCH_DEPTH):
+        """
+        Create the archive.
+
+        :param path: Output .npz path
+        :param max_pending: Maximum number of slices queued for compression
+        """
+        self.archive = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.names = []
+        self.max_pending = max(1, max_pending)
+        # A single thread, as zipfile members must be written one at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+
+    def _write_member(self, key, array):
+        """Write one array as a deflated .npy member."""
+        with self.archive.open(key + '.npy', 'w', force_zip64=True) as member:
+            np.lib.format.write_array(member, np.asarray(array), allow_pickle=False)
+
+    def write(self, name, img):
+        """
+        Queue a slice for compression. The image must not be modified afterwards.
+
+        :param name: Slice file name
+        :param img: Label image
+        """
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        key = f'slice_{len(self.names):05d}'
+        self.names.append(name)
+        self.pending.append(self.executor.submit(self._write_member, key, img))
+
+    def flush(self):
+        """
+        Wait for all queued slices to be compressed. The archive is only readable once closed.
+        """
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        """
+        Wait for all queued slices, store the slice names and close the archive.
+        """
+        try:
+            self.flush()
+            self.executor.submit(self._write_member, 'names', np.array(self.names)).result()
+        finally:
+            self.executor.shutdown()
+            self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def merge_label_volumes(paths, path):
+    """
+    Concatenate label volumes written by LabelVolumeWriter into one volume.
+
+    The merged volume is written next to the output and moved into place once
+    complete, so the output may also be one of the inputs. A slice that an
+    earlier input already holds is skipped.
+
+    :param paths: Volume paths in slice order
+    :param path: Output .npz path
+    :return: Number of slices in the merged volume
+    """
+    temporary_path = path + '.tmp'
+    merged = set()
+    with LabelVolumeWriter(temporary_path) as writer:
+        for part_path in paths:
+            with np.load(part_path) as part:
+                for index, name in enumerate(part['names'].tolist()):
+                    if name not in merged:
+                        merged.add(name)
+                        writer.write(name, part[f'slice_{index:05d}'])
+    os.replace(temporary_path, path)
+    return len(writer.names)
+
+
+class TrackRecordWriter:
+    """
+    Append per-yarn, per-slice track records to a compact binary file.
+
+    The file starts with TRACK_MAGIC, a uint64 header length and a JSON header,
+    padded to a multiple of 64 bytes, followed by TRACK_RECORD_DTYPE records.
+    Records are appended as each slice is tracked, so an interrupted run keeps
+    every completed slice. load_track_records maps the file back.
+    """
+
+    def __init__(self, path, append_after=None, **metadata):
+        """
+        Create the file and write its header, or continue an existing file.
+
+        :param path: Output path
+        :param append_after: Continue an existing file after this slice index, dropping any later
+                             records; None starts a new file
+        :param metadata: JSON-serializable values stored in the header, e.g. gray_value
+        """
+        if append_after is not None and os.path.exists(path):
+            with open(path, 'rb') as file:
+                _, offset = read_track_header(file, path)
+            records, _ = load_track_records(path)
+            # Records are written in slice order
+            keep = int(np.searchsorted(records['slice'], append_after, side='right'))
+            del records
+            self.file = open(path, 'r+b')
+            self.file.truncate(offset + keep * TRACK_RECORD_DTYPE.itemsize)
+            self.file.seek(0, os.SEEK_END)
+            return
+
+        header = json.dumps(dict(metadata, fields=TRACK_RECORD_DTYPE.descr)).encode('utf-8')
+        prefix_length = len(TRACK_MAGIC) + 8 + len(header)
+        header += b' ' * (-prefix_length % 64)
+        self.file = open(path, 'wb')
+        self.file.write(TRACK_MAGIC + struct.pack('<Q', len(header)) + header)
+
+    def write(self, records):
+        """
+        Append the records of one slice.
+
+        :param records: Array of TRACK_RECORD_DTYPE
+        """
+        self.file.write(np.ascontiguousarray(records, dtype=TRACK_RECORD_DTYPE).tobytes())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_track_header(file, path):
+    """
+    Read the header of a track record file.
+
+    :param file: File object opened in binary mode at the start of the file
+    :param path: File path, for the error message
+    :return: Header dictionary and the byte offset of the first record
+    """
+    if file.read(len(TRACK_MAGIC)) != TRACK_MAGIC:
+        raise ValueError(f"Not a track record file: {path}")
+    header_length, = struct.unpack('<Q', file.read(8))
+    metadata = json.loads(file.read(header_length).decode('utf-8'))
+    return metadata, len(TRACK_MAGIC) + 8 + header_length
+
+
+def load_track_records(path):
+    """
+    Map a track record file written by TrackRecordWriter.
+
+    A trailing partial record from an interrupted run is ignored.
+
+    :param path: Track record file path
+    :return: Read-only TRACK_RECORD_DTYPE array (columns as records['area'] etc.) and the header dictionary
+    """
+    with open(path, 'rb') as file:
+        metadata, offset = read_track_header(file, path)
+
+    count = (os.path.getsize(path) - offset) // TRACK_RECORD_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=TRACK_RECORD_DTYPE), metadata
+    return np.memmap(path, dtype=TRACK_RECORD_DTYPE, mode='r', offset=offset, shape=(count,)), metadata
+
+
+def pivot_track_records(records, field):
+    """
+    Arrange one record field as a (slices x yarns) table.
+
+    :param records: Track records, e.g. from load_track_records
+    :param field: Field name such as 'center_y' or 'area'
+    :return: (slice indices, yarn IDs, float table with NaN where a yarn has no record)
+    """
+    slices, slice_rows = np.unique(records['slice'], return_inverse=True)
+    yarns, yarn_columns = np.unique(records['yarn'], return_inverse=True)
+    table = np.full((len(slices), len(yarns)), np.nan)
+    table[slice_rows, yarn_columns] = records[field]
+    return slices, yarns, table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack slice folders into memory-mapped volume files.')
+    parser.add_argument('folders', nargs='+', help='Slice folders, e.g. ./Tracking/Sample_A_warp')
+    for folder in parser.parse_args().folders:
+        print(pack_volume(folder))